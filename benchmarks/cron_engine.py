@@ -0,0 +1,75 @@
+# Benchmark calculating next run times with croniter directly against the compiled schedules in crontrack.schedule
+#
+# Usage: python benchmarks/cron_engine.py [--jobs 10000] [--schedules 200]
+# Doesn't need a database: jobs are simulated as (schedule string, timezone) pairs.
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import pytz
+from croniter import croniter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crontrack.schedule import compile_schedule, make_horizon, next_from_horizon, next_run, next_runs
+
+TIMEZONES = ('UTC', 'Australia/Sydney', 'America/New_York', 'Europe/London', 'Asia/Kolkata')
+
+
+def random_schedule(rng):
+    minute = rng.choice(('*', '*/5', '*/15', '0', '30', str(rng.randrange(60))))
+    hour = rng.choice(('*', '*', '*/2', '9-17', str(rng.randrange(24))))
+    weekday = rng.choice(('*', '*', '*', '1-5', '0'))
+    return f'{minute} {hour} * * {weekday}'
+
+
+def timed(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32}{elapsed:8.3f}s  ({elapsed / count * 1e6:7.1f} us per job)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=10000, help="number of jobs to calculate next run times for")
+    parser.add_argument('--schedules', type=int, default=200, help="number of distinct schedule strings")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    schedules = [random_schedule(rng) for _ in range(args.schedules)]
+    jobs = [(rng.choice(schedules), pytz.timezone(rng.choice(TIMEZONES))) for _ in range(args.jobs)]
+    now = datetime.now(pytz.utc)
+
+    def use_croniter():
+        return [croniter(s, now.astimezone(tz)).get_next(datetime) for s, tz in jobs]
+
+    def use_compiled():
+        return [next_run(s, now.astimezone(tz)) for s, tz in jobs]
+
+    def use_batched():
+        runs = next_runs(jobs, now)
+        return [runs[job] for job in jobs]
+
+    horizons = [make_horizon(s, tz, now, 60) for s, tz in jobs]
+
+    def use_horizons():
+        return [next_from_horizon(h, s, tz, now) for h, (s, tz) in zip(horizons, jobs)]
+
+    print(f"Jobs: {args.jobs}, distinct schedules: {len(set(s for s, tz in jobs))}")
+    before = timed("croniter", use_croniter, args.jobs)
+    compile_schedule.cache_clear()
+    timed("compiled (cold cache)", use_compiled, args.jobs)
+    after = timed("compiled (warm cache)", use_compiled, args.jobs)
+    batched = timed("compiled, batched", use_batched, args.jobs)
+    horizon = timed("stored run horizons", use_horizons, args.jobs)
+    assert use_croniter() == use_compiled() == use_batched() == use_horizons()
+    print(f"Speedup: {before / after:.1f}x per job, {before / batched:.1f}x batched, {before / horizon:.1f}x horizons")
+
+
+if __name__ == '__main__':
+    main()
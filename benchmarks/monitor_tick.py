@@ -0,0 +1,67 @@
+# Benchmark a single job monitor pass where a large number of jobs fail at once (e.g. a host with many jobs going down)
+#
+# Usage: python benchmarks/monitor_tick.py [--jobs 10000] [--users 10]
+# Runs against a throwaway test database created from the configured database settings.
+import argparse
+import os
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crontrack_site.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from crontrack.background import JobMonitor
+from crontrack.models import Job, JobEvent, User, Team, TeamMembership
+
+
+def create_jobs(count, user_count):
+    users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(user_count)]
+    team = Team.objects.create(name='team', creator=users[0])
+    TeamMembership.objects.bulk_create(TeamMembership(user=user, team=team) for user in users)
+    
+    next_run = timezone.now() - timedelta(minutes=5)
+    jobs = []
+    for i in range(count):
+        job = Job(
+            user=users[i % user_count], team=(team if i % 2 else None), name=f'job {i}', schedule_str='*/5 * * * *',
+        )
+        job.set_next_run(next_run)
+        job.shard = job.id.int % Job.SHARD_COUNT
+        jobs.append(job)
+    Job.objects.bulk_create(jobs, batch_size=1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=10000, help="number of simultaneously failing jobs")
+    parser.add_argument('--users', type=int, default=10, help="number of users (all in one team)")
+    args = parser.parse_args()
+    
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        create_jobs(args.jobs, args.users)
+        
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            JobMonitor(time_limit=1, threaded=False)
+            elapsed = time.perf_counter() - start
+        
+        assert Job.objects.failed().count() == args.jobs
+        print(f"Jobs failed:        {args.jobs}")
+        print(f"Events created:     {JobEvent.objects.count()}")
+        print(f"Queries:            {len(context.captured_queries)}")
+        print(f"Monitor pass time:  {elapsed:.2f}s")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
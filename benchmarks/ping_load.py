@@ -0,0 +1,100 @@
+# Load test the ping endpoint of a running server with many concurrent pings, to compare how many pings it can
+# handle at once when served with WSGI (e.g. gunicorn sync workers) and with ASGI (e.g. uvicorn), e.g.
+#
+#   gunicorn -w 4 crontrack_site.wsgi:application &
+#   python benchmarks/ping_load.py --url http://localhost:8000 [--concurrency 500] [--pings 10000]
+#   uvicorn --workers 4 crontrack_site.asgi:application &
+#   python benchmarks/ping_load.py --url http://localhost:8000
+#
+# Creates temporary jobs in the configured database (which the server must be using too), and deletes them after.
+# Requires aiohttp.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crontrack_site.settings')
+
+import django
+django.setup()
+
+from django.utils import timezone
+
+from crontrack.models import Job, User
+
+
+def create_jobs(count):
+    name = f'ping_load_{os.getpid()}'
+    user = User.objects.create(username=name, email=f'{name}@example.com')
+    next_run = timezone.now() + timedelta(minutes=1)
+    jobs = []
+    for i in range(count):
+        job = Job(user=user, name=f'job {i}', schedule_str='* * * * *')
+        job.set_next_run(next_run)
+        job.shard = job.id.int % Job.SHARD_COUNT
+        jobs.append(job)
+    Job.objects.bulk_create(jobs, batch_size=1000)
+    return user, [job.id for job in jobs]
+
+
+async def run_load(url, ids, count, concurrency, timeout):
+    # Send count pings with at most concurrency in flight at a time, returning each one's latency (or None if it failed)
+    latencies = []
+    queue = asyncio.Queue()
+    rng = random.Random(0)
+    for _ in range(count):
+        queue.put_nowait(f'{url}/p/{rng.choice(ids)}/')
+
+    async def worker(session):
+        while not queue.empty():
+            ping_url = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                async with session.get(ping_url) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            latencies.append(time.perf_counter() - start if ok else None)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://localhost:8000', help="base URL of the server")
+    parser.add_argument('--jobs', type=int, default=1000, help="number of jobs sending pings")
+    parser.add_argument('--pings', type=int, default=10000, help="number of pings to send")
+    parser.add_argument('--concurrency', type=int, default=500, help="number of pings in flight at once")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds before a ping counts as failed")
+    args = parser.parse_args()
+
+    user, ids = create_jobs(args.jobs)
+    try:
+        start = time.perf_counter()
+        latencies = asyncio.run(run_load(args.url.rstrip('/'), ids, args.pings, args.concurrency, args.timeout))
+        elapsed = time.perf_counter() - start
+    finally:
+        user.delete()
+
+    succeeded = sorted(latency for latency in latencies if latency is not None)
+    print(f"Pings:              {args.pings} ({args.concurrency} at a time)")
+    print(f"Failed:             {args.pings - len(succeeded)}")
+    print(f"Pings per second:   {len(succeeded) / elapsed:.0f}")
+    if succeeded:
+        print(f"Median latency:     {succeeded[len(succeeded) // 2] * 1000:.0f}ms")
+        print(f"99th percentile:    {succeeded[int(len(succeeded) * 0.99)] * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
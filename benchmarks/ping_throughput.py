@@ -0,0 +1,82 @@
+# Benchmark the ping endpoint jobs call when they run (notify_job), reporting pings per second and queries per ping
+#
+# Usage: python benchmarks/ping_throughput.py [--jobs 1000] [--pings 5000] [--buffer memory|spool]
+# Runs against a throwaway test database created from the configured database settings.
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crontrack_site.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from crontrack import pings
+from crontrack.models import Job, User
+
+
+def create_jobs(count):
+    user = User.objects.create(username='user', email='user@example.com')
+    next_run = timezone.now() + timedelta(minutes=1)
+    jobs = []
+    for i in range(count):
+        job = Job(user=user, name=f'job {i}', schedule_str='* * * * *')
+        job.set_next_run(next_run)
+        job.shard = job.id.int % Job.SHARD_COUNT
+        jobs.append(job)
+    Job.objects.bulk_create(jobs, batch_size=1000)
+    return [job.id for job in jobs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=1000, help="number of jobs sending pings")
+    parser.add_argument('--pings', type=int, default=5000, help="number of pings to send")
+    parser.add_argument('--buffer', choices=pings.BUFFER_MODES[1:], help="buffer pings (see settings.PING_BUFFER)")
+    args = parser.parse_args()
+
+    setup_test_environment()
+    override_settings(PING_BUFFER=args.buffer).enable()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        ids = create_jobs(args.jobs)
+        rng = random.Random(0)
+        urls = [reverse('crontrack:notify_job', args=[rng.choice(ids)]) for _ in range(args.pings)]
+        client = Client()
+
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            start = time.perf_counter()
+            for url in urls:
+                response = client.get(url)
+                assert response.status_code == 200, response.status_code
+            elapsed = time.perf_counter() - start
+            if args.buffer is not None:
+                pings.get_buffer().stop()
+        assert Job.objects.filter(last_notified__isnull=False).count() == len(set(urls))
+
+        print(f"Pings:              {args.pings}")
+        print(f"Queries per ping:   {queries / args.pings:.1f}")
+        print(f"Pings per second:   {args.pings / elapsed:.0f}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# Alert delivery (sending the alerts queued by the job monitor by email / SMS)
+import logging
+import threading
+import uuid
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import groupby
+
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from django.conf import settings
+from django.core import mail
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from .models import PendingAlert, User
+
+logger = logging.getLogger(__name__)
+
+TWILIO_TIMEOUT = 30  # seconds to wait for Twilio to respond
+EMAIL_TEMPLATES = ('crontrack/email/alertuser.html', 'crontrack/email/alertdigest.html')
+SMS_TEMPLATES = ('crontrack/sms/alertuser.txt', 'crontrack/sms/alertdigest.txt')
+
+# Dispatchers running in this process, so the job monitor can wake them when it queues alerts
+_dispatchers = weakref.WeakSet()
+
+
+def wake_dispatchers():
+    for dispatcher in list(_dispatchers):
+        dispatcher.wakeup.set()
+
+
+class AlertDispatcher:
+    WAIT_INTERVAL = 10  # seconds between checking for alerts to send
+    BATCH_SIZE = 100  # maximum number of alerts to send at a time
+    MAX_ATTEMPTS = 5  # number of times to try sending an alert before giving up
+    RETRY_DELAY = 30  # seconds to wait before retrying a failed alert (doubled for each failed attempt)
+    CLAIM_TIME = 300  # seconds an alert is reserved for while a dispatcher is sending it
+    CLEANUP_INTERVAL = 3600  # seconds between deleting alerts older than settings.ALERT_RETENTION_DAYS
+
+    def __init__(self, time_limit=None, threaded=True, workers=None, twilio_client=None):
+        self.time_limit = time_limit  # maximum time to run for in seconds
+        if time_limit is not None and time_limit <= 0:
+            raise ValueError("Time limit must be a positive number of seconds or None")
+
+        self.workers = workers or getattr(settings, 'ALERT_WORKERS', 4)
+        if self.workers <= 0:
+            raise ValueError("Number of alert workers must be a positive number")
+
+        self.twilio_client = twilio_client
+        self.name = f'dispatcher:{uuid.uuid4().hex}'
+        self.start_time = timezone.now()
+        self.running = True
+        self.last_cleaned = None  # when old alerts were last deleted
+        self.wakeup = threading.Event()
+        _dispatchers.add(self)
+
+        if threaded:
+            logger.debug(f"Starting AlertDispatcher on a separate thread with time limit '{time_limit}'")
+            self.t = threading.Thread(target=self.dispatch_loop, name='AlertDispatcherThread', daemon=True)
+            self.t.start()
+        else:
+            logger.debug(f"Starting AlertDispatcher on main thread with time limit '{time_limit}'")
+            self.t = None
+            self.dispatch_loop()
+
+    def stop(self):
+        logger.debug("Stopping AlertDispatcher")
+        self.running = False
+        _dispatchers.discard(self)
+        self.wakeup.set()
+
+    def dispatch_loop(self):
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='AlertWorker') as self.executor:
+            while self.running:
+                try:
+                    # Keep going without waiting while there's a backlog
+                    while self.running and self.send_pending() == self.BATCH_SIZE:
+                        pass
+                except Exception:
+                    # A failed pass (e.g. after losing the database connection) is tried again after the usual
+                    # interval with any broken connection replaced, rather than stopping alerts being sent for good
+                    logger.exception("Error sending alerts")
+                    close_old_connections()
+                try:
+                    self.delete_old()
+                except Exception:
+                    # Cleaning up is tried again after the next interval, rather than stopping alerts being sent
+                    logger.exception("Error deleting old alerts")
+                    self.last_cleaned = timezone.now()
+
+                # Check if we're due to stop running
+                if self.time_limit is not None:
+                    next_iteration = timezone.now() + timedelta(seconds=self.WAIT_INTERVAL)
+                    stop_time = self.start_time + timedelta(seconds=self.time_limit)
+                    if next_iteration > stop_time:
+                        self.stop()
+                        break
+
+                self.wakeup.wait(self.WAIT_INTERVAL)
+                self.wakeup.clear()
+
+    def delete_old(self):
+        # Delete alerts sent, or given up on, more than ALERT_RETENTION_DAYS ago (every CLEANUP_INTERVAL seconds).
+        # Returns the number of alerts deleted.
+        days = getattr(settings, 'ALERT_RETENTION_DAYS', None)
+        now = timezone.now()
+        if days is None:
+            return 0
+        if self.last_cleaned is not None and now < self.last_cleaned + timedelta(seconds=self.CLEANUP_INTERVAL):
+            return 0
+
+        # A given up alert's next_attempt is when its last attempt would have been retried
+        before = now - timedelta(days=days)
+        deleted, _ = PendingAlert.objects.filter(
+            Q(sent__lt=before) | Q(sent__isnull=True, attempts__gte=self.MAX_ATTEMPTS, next_attempt__lt=before),
+        ).delete()
+        self.last_cleaned = now
+        if deleted:
+            logger.debug(f"Deleted {deleted} alert(s) from before {before}")
+        return deleted
+
+    def send_pending(self):
+        # Claim a batch of alerts which are due to be sent, send them, and record the results.
+        # Returns the number of alerts claimed.
+        now = timezone.now()
+        due = (
+            PendingAlert.objects
+            .filter(sent__isnull=True, next_attempt__lte=now, attempts__lt=self.MAX_ATTEMPTS)
+            .order_by('next_attempt')
+            .values_list('id', flat=True)[:self.BATCH_SIZE]
+        )
+
+        # Claiming pushes back next_attempt, so other dispatchers skip these alerts unless we die while sending
+        claim = f'{self.name}:{now.timestamp()}'
+        claimed_until = now + timedelta(seconds=self.CLAIM_TIME)
+        PendingAlert.objects.filter(id__in=list(due), sent__isnull=True, next_attempt__lte=now).update(
+            claim=claim, next_attempt=claimed_until,
+        )
+        # Once a digest is due, every other unclaimed alert waiting for that user goes out in it too
+        PendingAlert.objects.filter(
+            user__in=PendingAlert.objects.filter(claim=claim, user__alert_digest=True).values('user'),
+            sent__isnull=True,
+            claim='',
+            attempts__lt=self.MAX_ATTEMPTS,
+        ).update(claim=claim, next_attempt=claimed_until)
+        alerts = list(
+            PendingAlert.objects
+            .filter(claim=claim, sent__isnull=True)
+            .select_related('user', 'job__user', 'job__team', 'job__group')
+            .order_by('user', 'run_time')
+        )
+        if not alerts:
+            return 0
+
+        results = self.send_alerts(alerts)
+
+        # Record the results, grouping alerts that need the same update into a single statement
+        now = timezone.now()
+        sent = [alert.id for alert in alerts if results[alert.id] is None]
+        PendingAlert.objects.filter(id__in=sent).update(sent=now, attempts=F('attempts') + 1, error='')
+        failed = defaultdict(list)
+        for alert in alerts:
+            error = results[alert.id]
+            if error is not None:
+                logger.warning(f"Failed to send alert '{alert.key}' (attempt {alert.attempts + 1}): {error}")
+                failed[(alert.attempts + 1, error[:200])].append(alert.id)
+        for (attempts, error), ids in failed.items():
+            retry_delay = timedelta(seconds=self.RETRY_DELAY * 2 ** (attempts - 1))
+            PendingAlert.objects.filter(id__in=ids).update(
+                attempts=attempts, error=error, claim='', next_attempt=now + retry_delay,
+            )
+
+        return len(alerts)
+
+    def send_alerts(self, alerts):
+        # Send a batch of alerts, returning a dict of alert IDs to None if successful or a description of the error.
+        # Emails are split between the worker threads, each reusing one mail connection for its share, while texts
+        # are sent individually using the shared Twilio client (which pools its HTTP connections).
+        results = {}
+        emails = []
+        texts = []
+        for user, messages in group_messages(alerts):
+            if user.alert_method == User.EMAIL:
+                emails += messages
+            elif user.alert_method == User.SMS:
+                texts += messages
+            else:
+                logger.debug(f"Not alerting user '{user}' as they have disabled all alerts since it was queued")
+                for message in messages:
+                    results.update((alert.id, None) for alert in message)
+
+        email_batches = [emails[i::self.workers] for i in range(min(self.workers, len(emails)))]
+        for batch_results in self.executor.map(send_emails, email_batches):
+            results.update(batch_results)
+        twilio_client = (self.twilio_client or get_twilio_client()) if texts else None
+        for message, error in zip(texts, self.executor.map(lambda message: send_text(message, twilio_client), texts)):
+            results.update((alert.id, error) for alert in message)
+        return results
+
+
+# Shared Twilio client, reused between alerts so HTTP connections to Twilio are kept alive
+_twilio_client = None
+_twilio_client_lock = threading.Lock()
+
+
+def get_twilio_client():
+    global _twilio_client
+    with _twilio_client_lock:
+        if _twilio_client is None:
+            http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT)
+            _twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client)
+        return _twilio_client
+
+
+def group_messages(alerts):
+    # Split alerts (sorted by user) into the messages to send each user: a single digest message containing all of
+    # their alerts if they've enabled digests, or a message per alert otherwise.
+    # Yields (user, messages) pairs, where each message is a list of alerts.
+    for user, user_alerts in groupby(alerts, key=lambda alert: alert.user_id):
+        user_alerts = list(user_alerts)
+        user = user_alerts[0].user
+        if user.alert_digest:
+            yield user, [user_alerts]
+        else:
+            yield user, [[alert] for alert in user_alerts]
+
+
+def render_message(message, templates):
+    # templates is a (single alert template, digest template) pair
+    context = {'user': message[0].user, 'protocol': settings.SITE_PROTOCOL, 'domain': settings.SITE_DOMAIN}
+    if len(message) == 1:
+        # Render in the job owner's timezone
+        alert = message[0]
+        timezone.activate(alert.job.user.timezone)
+        context.update({'job': alert.job, 'run_time': alert.run_time})
+        return render_to_string(templates[0], context)
+    else:
+        # Digests list jobs from different owners, so render in the recipient's timezone
+        timezone.activate(message[0].user.timezone)
+        context['alerts'] = message
+        return render_to_string(templates[1], context)
+
+
+def send_emails(messages):
+    # Send a batch of email messages over a single connection, returning a dict of alert IDs to errors (or None)
+    results = {}
+    try:
+        with mail.get_connection() as connection:
+            for message in messages:
+                user = message[0].user
+                logger.debug(f"Sending user '{user}' an email at {user.email}")
+                if len(message) == 1:
+                    subject = f"[CronTrack] ALERT: Job '{message[0].job.name}' failed to notify in time"
+                else:
+                    subject = f"[CronTrack] ALERT: {len(message)} jobs failed to notify in time"
+                html_message = render_message(message, EMAIL_TEMPLATES)
+                email = mail.EmailMultiAlternatives(
+                    subject, strip_tags(html_message), to=[user.email], connection=connection,
+                )
+                email.attach_alternative(html_message, 'text/html')
+                try:
+                    email.send()
+                except Exception as e:
+                    error = describe_error(e)
+                else:
+                    error = None
+                results.update((alert.id, error) for alert in message)
+    except Exception as e:
+        # Couldn't open (or close) the connection
+        error = describe_error(e)
+        for message in messages:
+            for alert in message:
+                results.setdefault(alert.id, error)
+    return results
+
+
+def send_text(message, twilio_client):
+    # Send an SMS message, returning None if successful or a description of the error otherwise
+    user = message[0].user
+    logger.debug(f"Sending user '{user}' an SMS at {user.phone}")
+    body = render_message(message, SMS_TEMPLATES)
+    try:
+        twilio_client.messages.create(body=body, to=str(user.phone), from_=settings.TWILIO_FROM_NUMBER)
+    except Exception as e:
+        return describe_error(e)
+    return None
+
+
+def describe_error(e):
+    return f'{type(e).__name__}: {e}'
@@ -0,0 +1,147 @@
+# Read-only JSON API for the jobs and events a user can see (e.g. for status boards), under /api/v1/.
+# Responses carry an ETag made from the change counters of the user and their teams (see counters.py), so polls sending
+# it back in If-None-Match get a 304 as soon as nothing has changed, before any jobs or events are loaded. Without a
+# shared cache for the counters (settings.CHANGE_COUNTER_CACHE) responses have no ETag and every poll is answered in full.
+import hashlib
+import uuid
+from functools import wraps
+from operator import attrgetter
+
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_safe
+from django.views.decorators.vary import vary_on_cookie
+
+from . import counters
+from .models import JobEvent
+from .views import filter_jobs, get_job_filters, get_scoped_jobs
+
+API_VERSION = 1
+PAGE_SIZE = 100  # number of results per page, unless a limit is given
+MAX_PAGE_SIZE = 1000  # maximum number of results per page
+
+# Fields which can be selected (all by default), each with the model field to load for it and how to get its value
+JOB_FIELDS = {
+    'id': ('id', attrgetter('id')),
+    'name': ('name', attrgetter('name')),
+    'description': ('description', attrgetter('description')),
+    'schedule': ('schedule_str', attrgetter('schedule_str')),
+    'time_window': ('time_window', attrgetter('time_window')),
+    'next_run': ('next_run', attrgetter('next_run')),
+    'last_failed': ('last_failed', attrgetter('last_failed')),
+    'last_notified': ('last_notified', attrgetter('last_notified')),
+    'status': ('id', attrgetter('status')),  # worked out in the query
+    'team': ('team', attrgetter('team_id')),
+    'group': ('group', attrgetter('group_id')),
+}
+EVENT_FIELDS = {
+    'id': ('id', attrgetter('id')),
+    'job': ('job', attrgetter('job_id')),
+    'type': ('type', lambda event: event.get_type_display().lower()),
+    'time': ('time', attrgetter('time')),
+    'seen': ('seen', attrgetter('seen')),
+}
+
+
+def get_etag(request, *args, **kwargs):
+    # Changes anywhere in what the user can see change the ETag of every page, so it's only unique per URL
+    token = counters.version(request.user)
+    if token is None:
+        return None
+    return hashlib.md5(f'{API_VERSION}:{request.user.id}:{request.get_full_path()}:{token}'.encode()).hexdigest()
+
+
+def api_view(view):
+    # Only allow GET (and HEAD) requests from logged in users (with an error rather than a redirect to the login page),
+    # and answer conditional requests without calling the view if nothing has changed
+    conditional = condition(etag_func=get_etag)(view)
+
+    @wraps(view)
+    @require_safe
+    @vary_on_cookie
+    @cache_control(private=True, no_cache=True)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error_message': "not logged in"}, status=401)
+        return conditional(request, *args, **kwargs)
+    return wrapper
+
+
+# Gets the fields selected with the fields parameter (a comma separated list), raising ValueError if any are unknown
+def get_fields(request, available):
+    if 'fields' not in request.GET:
+        return list(available)
+    fields = [field for field in request.GET['fields'].split(',') if field]
+    if not fields or any(field not in available for field in fields):
+        raise ValueError(f"unknown field in {request.GET['fields']}")
+    return fields
+
+
+def get_limit(request):
+    limit = int(request.GET.get('limit', PAGE_SIZE))
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+# Gets the response for a page of results, with their selected fields and the URL of the next page (or None)
+def page_response(request, results, fields, available, after):
+    if after is None:
+        next_url = None
+    else:
+        params = request.GET.copy()
+        params['after'] = after
+        next_url = request.build_absolute_uri('?' + params.urlencode())
+    return JsonResponse({
+        'results': [{field: available[field][1](result) for field in fields} for result in results],
+        'next': next_url,
+    })
+
+
+@api_view
+def jobs(request):
+    # The user's jobs, filtered as on the view jobs page (by team, group, name prefix, schedule and status) and paged
+    # by ID: each page follows on from the last job on the one before
+    try:
+        filters = get_job_filters(request.GET)
+        fields = get_fields(request, JOB_FIELDS)
+        limit = get_limit(request)
+        after = uuid.UUID(request.GET['after']) if 'after' in request.GET else None
+    except ValueError:
+        return JsonResponse({'error_message': "invalid parameters"}, status=400)
+
+    now = timezone.now()
+    jobs = filter_jobs(get_scoped_jobs(request.user, filters), filters, now)
+    if after is not None:
+        jobs = jobs.filter(id__gt=after)
+    jobs = jobs.only(*{JOB_FIELDS[field][0] for field in fields}).with_status(now).order_by('id')
+    jobs = list(jobs[:limit + 1])
+    after = str(jobs[limit - 1].id) if len(jobs) > limit else None
+    return page_response(request, jobs[:limit], fields, JOB_FIELDS, after)
+
+
+@api_view
+def events(request):
+    # The user's job events, newest first, paged by (time, ID) as on the dashboard
+    try:
+        fields = get_fields(request, EVENT_FIELDS)
+        limit = get_limit(request)
+        after = None
+        if 'after' in request.GET:
+            time, id = request.GET['after'].rsplit(',', 1)
+            after = (parse_datetime(time), int(id))
+            if after[0] is None:
+                raise ValueError
+    except ValueError:
+        return JsonResponse({'error_message': "invalid parameters"}, status=400)
+
+    events = request.user.all_accessible(JobEvent).order_by('-time', '-id')
+    if after is not None:
+        time, id = after
+        events = events.filter(Q(time__lt=time) | Q(time=time, id__lt=id))
+    events = list(events.only('id', *{EVENT_FIELDS[field][0] for field in fields})[:limit + 1])
+    after = f'{events[limit - 1].time.isoformat()},{events[limit - 1].id}' if len(events) > limit else None
+    return page_response(request, events[:limit], fields, EVENT_FIELDS, after)
@@ -7,8 +7,11 @@ class CronTrackConfig(AppConfig):
     name = 'crontrack'
     
     def ready(self):
+        from . import counters  # connects the signal handlers keeping unseen event counts up to date
+        from .alerts import AlertDispatcher
         from .background import JobMonitor
         
         # Only run the monitor in the main thread
         if settings.JOB_MONITOR_ON and os.environ.get('RUN_MAIN') == 'true':
-            monitor = JobMonitor(threaded=True)
\ No newline at end of file
+            monitor = JobMonitor(threaded=True, event_driven=getattr(settings, 'JOB_MONITOR_EVENT_DRIVEN', False))
+            dispatcher = AlertDispatcher(threaded=True)
\ No newline at end of file
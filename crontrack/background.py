@@ -1,34 +1,69 @@
 # Background Tasks (main loop logic for job notification handling)
-import time
+import heapq
+import math
+import os
+import socket
 import threading
 import logging
-from datetime import datetime, timedelta
+import uuid
+import weakref
+from collections import Counter, defaultdict
+from datetime import timedelta
 
-from croniter import croniter
-from twilio.base.exceptions import TwilioRestException
-from twilio.rest import Client
-
-from django.core import mail
 from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
 from django.utils import timezone
-from django.utils.html import strip_tags
-from django.template.loader import render_to_string
 
-from .models import Job, JobAlert, JobEvent, User, TeamMembership
+from . import counters, retention
+from .alerts import wake_dispatchers
+from .models import Job, JobAlert, JobEvent, MonitorLease, MonitorWorker, PendingAlert, User, TeamMembership
+from .schedule import next_runs
 
 logger = logging.getLogger(__name__)
 
+# Monitors running in this process, so views can wake them when a job's schedule changes
+_monitors = weakref.WeakSet()
+
+
+# Tell any event-driven monitors in this process about a job's new next run time
+def reschedule_job(job):
+    for monitor in list(_monitors):
+        monitor.schedule(job)
+
 
 class JobMonitor:
-    WAIT_INTERVAL = 60  # seconds for time.sleep()
+    WAIT_INTERVAL = 60  # seconds between passes (or the maximum time between reloading the schedule if event-driven)
+    MIN_WAIT = 1  # seconds to wait at minimum between event-driven passes, so close deadlines get checked together
+    HEAP_SIZE = 1000  # maximum number of upcoming jobs to load into the schedule at a time
+    LEASE_TIME = 300  # seconds a sharded worker holds its shards for without renewing them (renewed every pass)
+    CHUNK_SIZE = 500  # maximum number of due jobs to update in a single transaction
+    ARCHIVE_LIMIT = 100000  # maximum number of old events to archive per pass (the rest are left for the next ones)
     
-    def __init__(self, time_limit=None, threaded=True):
+    def __init__(self, time_limit=None, threaded=True, event_driven=False, sharded=False):
         self.time_limit = time_limit  # maximum time to run for in seconds
         if time_limit is not None and time_limit <= 0:
             raise ValueError("Time limit must be a positive number of seconds or None")
         
         self.start_time = timezone.now()
         self.running = True
+        self.grace = timedelta(0)  # extra time allowed for buffered pings to be written (see pings.buffer_delay)
+        self.last_archived = None  # when old events were last archived (see settings.EVENT_ARCHIVE_INTERVAL)
+        
+        # Event-driven scheduling: a min-heap of (time, job ID) entries for upcoming next run times and deadlines.
+        # Entries are only valid while they match the times in self.scheduled (older ones are skipped when popped).
+        self.event_driven = event_driven
+        self.heap = []
+        self.scheduled = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        if event_driven:
+            _monitors.add(self)
+        
+        # Sharded mode: several workers split the jobs between them by leasing shards (see MonitorLease)
+        self.sharded = sharded
+        self.shards = []
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
         
         if threaded:
             logger.debug(f"Starting JobMonitor on a separate thread with time limit '{time_limit}'")
@@ -42,100 +77,315 @@ class JobMonitor:
     def stop(self):
         logger.debug("Stopping JobMonitor")
         self.running = False
+        _monitors.discard(self)
+        self.wakeup.set()
     
     def monitor_loop(self):
         while self.running:
             logger.debug(f"Starting monitor loop at {timezone.now()}")
-            for job in Job.objects.all():
-                # Set now to a constant time for this iteration
-                now = timezone.now()
-            
-                # Calculate the next scheduled run time + time window
-                run_by = job.next_run + timedelta(minutes=job.time_window)
-                
-                # If this run time is in the future, check if we need to issue a warning, then move on
-                if run_by > now:
-                    if job.failing and not JobEvent.objects.filter(job=job, type=JobEvent.WARNING).exists():
-                        JobEvent.objects.create(job=job, type=JobEvent.WARNING, time=job.next_run)
-                        logger.debug(f"Warning created: job {job} is failing")
-                    continue
-                
-                # Change to local time (for alerts / calculating next run time)
-                timezone.activate(job.user.timezone)
-                
-                # Check if a notification was not received in the time window
-                if job.last_notified is None or not (job.next_run <= job.last_notified <= run_by):
-                    # Error condition: the job did not send a notification
-                    logger.debug(f"Alert! Job: {job} failed to notify in the time window")
-                    
-                    # Check if the job has already failed to avoid sending multiple notifications
-                    if job.failed:
-                        logger.debug(f"Skipped sending another alert for continually failing job {job}")
-                    else:
-                        # Try alerting users in the relevant team
-                        if job.team is None:
-                            users = (job.user,)
-                        else:
-                            users = job.team.user_set.all()
-                        for user in users:
-                            if user not in job.alerted_users.all():
-                                # Send an alert if it's our first
-                                JobAlert.objects.create(user=user, job=job, last_alert=now)
-                                self.alert_user(user, job)
-                            else:
-                                # Otherwise, decide whether to skip alerting based on the user's alert_buffer setting
-                                buffer_time = timedelta(minutes=user.alert_buffer)
-                                last_alert = JobAlert.objects.get(job=job, user=user).last_alert
-                                if now > last_alert + buffer_time:
-                                    self.alert_user(user, job)
-                                else:
-                                    logger.debug(f"Skipped alerting user '{user}' of failed job {job}")
-
-                    job.last_failed = now
-                    JobEvent.objects.create(job=job, type=JobEvent.FAILURE, time=now)
+            try:
+                if self.sharded:
+                    self.shards = self.claim_shards()
+                self.check_jobs()
+                try:
+                    self.archive_events()
+                except Exception:
+                    # Archiving is tried again after the next interval, rather than stopping the monitor checking jobs
+                    logger.exception("Error archiving old events")
+                    self.last_archived = timezone.now()
                 
-                # Calculate the new next run time
-                job.next_run = croniter(job.schedule_str, timezone.localtime(now)).get_next(datetime)
-                job.save()
+                if self.event_driven:
+                    wait = self.load_schedule()
+                else:
+                    wait = self.WAIT_INTERVAL
+            except Exception:
+                # A failed pass (e.g. while the database is unavailable) is tried again after the usual interval with
+                # any broken connection replaced, rather than stopping the monitor for good
+                logger.exception("Error in JobMonitor loop")
+                close_old_connections()
+                wait = self.WAIT_INTERVAL
             
             # Check if we're due to stop running
             if self.time_limit is not None: 
-                next_iteration = timezone.now() + timedelta(seconds=self.WAIT_INTERVAL)
+                next_iteration = timezone.now() + timedelta(seconds=wait)
                 stop_time = self.start_time + timedelta(seconds=self.time_limit)
                 if next_iteration > stop_time:
                     self.stop()
                     break
             
-            time.sleep(self.WAIT_INTERVAL)
+            self.wait(wait)
+        
+        if self.sharded:
+            self.release_shards()
+    
+    def wait(self, seconds):
+        # Sleep until the timeout or until woken up by a job being rescheduled earlier (or the monitor stopping)
+        logger.debug(f"JobMonitor sleeping for {seconds:.1f} seconds")
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+        if self.event_driven and self.running:
+            # Always leave a short gap so a burst of wake-ups are handled in a single pass
+            self.wakeup.wait(self.MIN_WAIT)
+            self.wakeup.clear()
+    
+    def archive_events(self):
+        # Roll up events older than the retention period every EVENT_ARCHIVE_INTERVAL hours, if enabled.
+        # Only one sharded worker (whichever holds shard 0) does it.
+        interval = getattr(settings, 'EVENT_ARCHIVE_INTERVAL', None)
+        before = retention.retention_cutoff()
+        if interval is None or before is None or (self.sharded and 0 not in self.shards):
+            return
+        if self.last_archived is not None and timezone.now() < self.last_archived + timedelta(hours=interval):
+            return
+        
+        # Big backlogs are archived a limited amount at a time, so the monitor gets back to checking jobs
+        if retention.archive_events(before, limit=self.ARCHIVE_LIMIT) < self.ARCHIVE_LIMIT:
+            self.last_archived = timezone.now()
+    
+    def claim_shards(self):
+        # Renew this worker's leases, then take or give up shards so that each live worker holds a fair share.
+        # Returns the shards this worker is now responsible for.
+        now = timezone.now()
+        expires = now + timedelta(seconds=self.LEASE_TIME)
+        MonitorLease.objects.bulk_create(
+            (MonitorLease(shard=shard) for shard in range(Job.SHARD_COUNT)),
+            ignore_conflicts=True,
+        )
+        MonitorLease.objects.filter(owner=self.worker_id).update(expires=expires)
+        MonitorWorker.objects.update_or_create(name=self.worker_id, defaults={'expires': expires})
+        MonitorWorker.objects.filter(expires__lte=now).delete()
+        
+        leases = list(MonitorLease.objects.filter(shard__lt=Job.SHARD_COUNT).order_by('shard'))
+        fair_share = math.ceil(Job.SHARD_COUNT / MonitorWorker.objects.count())
+        
+        shards = [lease.shard for lease in leases if lease.owner == self.worker_id]
+        if len(shards) > fair_share:
+            # Free up our excess shards for workers which have joined since
+            MonitorLease.objects.filter(owner=self.worker_id, shard__in=shards[fair_share:]).update(
+                owner='', expires=None,
+            )
+            shards = shards[:fair_share]
+        
+        for lease in leases:
+            if len(shards) >= fair_share:
+                break
+            if lease.owner == self.worker_id or (lease.expires is not None and lease.expires > now):
+                continue
+            # Only claim the lease if nobody else has changed it since we read it
+            claimed = MonitorLease.objects.filter(shard=lease.shard, owner=lease.owner, expires=lease.expires).update(
+                owner=self.worker_id, expires=expires,
+            )
+            if claimed:
+                logger.debug(f"Worker '{self.worker_id}' claimed shard {lease.shard} from '{lease.owner}'")
+                shards.append(lease.shard)
+        
+        return shards
+    
+    def release_shards(self):
+        MonitorLease.objects.filter(owner=self.worker_id).update(owner='', expires=None)
+        MonitorWorker.objects.filter(name=self.worker_id).delete()
+        self.shards = []
+    
+    def get_jobs(self):
+        # Get the jobs this monitor is responsible for
+        if self.sharded:
+            return Job.objects.filter(shard__in=self.shards)
+        return Job.objects.all()
+    
+    def load_schedule(self):
+        # Reload the upcoming next run times / deadlines from the database, and return the time until the earliest
+        # one in seconds (capped at WAIT_INTERVAL so changes made by other processes are picked up eventually)
+        now = timezone.now()
+        jobs = (
+            self.get_jobs()
+            .filter(deadline__gt=now - self.grace)
+            .order_by('deadline')
+            .values_list('id', 'next_run', 'deadline')[:self.HEAP_SIZE]
+        )
+        with self.lock:
+            self.heap = []
+            self.scheduled = {}
+            for id, next_run, deadline in jobs:
+                self._push(id, next_run, deadline)
+        return self.time_until_next(now)
+    
+    def schedule(self, job):
+        # Add or update a job's entries in the heap, waking the monitor if it's now due before it would next wake
+        if self.sharded and job.shard not in self.shards:
+            return
+        with self.lock:
+            earliest = self.heap[0][0] if self.heap else None
+            self._push(job.id, job.next_run, job.deadline)
+            if earliest is None or self.heap[0][0] < earliest:
+                self.wakeup.set()
+    
+    def _push(self, id, next_run, deadline):
+        # Warnings are issued once next_run passes, and failures once the deadline passes
+        self.scheduled[id] = (next_run, deadline)
+        heapq.heappush(self.heap, (next_run, id))
+        if deadline != next_run:
+            heapq.heappush(self.heap, (deadline, id))
+    
+    def time_until_next(self, now):
+        # Times are only due once the grace period for buffered pings has passed too
+        now -= self.grace
+        with self.lock:
+            # Discard entries which have passed or were superseded by rescheduling
+            while self.heap:
+                when, id = self.heap[0]
+                if when > now and when in self.scheduled.get(id, ()):
+                    return min((when - now).total_seconds(), self.WAIT_INTERVAL)
+                heapq.heappop(self.heap)
+        return self.WAIT_INTERVAL
+    
+    def check_jobs(self):
+        from .pings import buffer_delay, flush_pings
+        
+        # Set now to a constant time for this iteration
+        now = timezone.now()
+        
+        # Make sure buffered pings have been written before deciding which jobs have missed theirs: this process's
+        # are written now, and those buffered by other processes are allowed for by only checking up to the cutoff
+        flush_pings()
+        self.grace = buffer_delay()
+        cutoff = now - self.grace
+        
+        # Issue warnings for jobs which have missed their next run time but are still within their time window
+        warning_jobs = (
+            self.get_jobs()
+            .filter(deadline__gt=cutoff, next_run__lt=cutoff, last_failed__isnull=True)
+            .filter(Q(last_notified__isnull=True) | Q(last_notified__lt=F('next_run')))
+            .filter(has_warning=False)
+            .only('id', 'next_run', 'user', 'team')
+        )
+        with transaction.atomic():
+            warnings = JobEvent.objects.bulk_create(
+                (JobEvent(job=job, type=JobEvent.WARNING, time=job.next_run) for job in warning_jobs),
+                batch_size=self.CHUNK_SIZE,
+            )
+            # Flag the jobs so notifications know to delete their warnings
+            for i in range(0, len(warnings), self.CHUNK_SIZE):
+                warned = [warning.job_id for warning in warnings[i:i + self.CHUNK_SIZE]]
+                Job.objects.filter(id__in=warned).update(has_warning=True)
+        counters.adjust(Counter((warning.job.user_id, warning.job.team_id) for warning in warnings))
+        counters.touch({(warning.job.user_id, warning.job.team_id) for warning in warnings})
+        if warnings:
+            logger.debug(f"Warnings created: {len(warnings)} job(s) are failing")
+        
+        # Only jobs whose deadline (next run time + time window) has passed need to be checked for failure
+        due_jobs = list(self.get_jobs().filter(deadline__lte=cutoff).select_related('user', 'team', 'group'))
+        for i in range(0, len(due_jobs), self.CHUNK_SIZE):
+            self.check_due_jobs(due_jobs[i:i + self.CHUNK_SIZE], now)
+    
+    def check_due_jobs(self, jobs, now):
+        # Check if a notification was not received in the time window
+        missed_jobs = {
+            job.id for job in jobs
+            if job.last_notified is None or not (job.next_run <= job.last_notified <= job.deadline)
+        }
+        
+        # Load the users to alert for newly failed jobs and their previous alerts up front, rather than per job
+        # Check if the job has already failed to avoid sending multiple notifications
+        new_failures = [job for job in jobs if job.id in missed_jobs and not job.failed]
+        team_members = defaultdict(list)
+        memberships = (
+            TeamMembership.objects
+            .filter(team__in={job.team_id for job in new_failures if job.team_id is not None})
+            .select_related('user')
+        )
+        for membership in memberships:
+            team_members[membership.team_id].append((membership.user, membership.alerts_on))
+        job_alerts = {(alert.job_id, alert.user_id): alert for alert in JobAlert.objects.filter(job__in=new_failures)}
+        
+        # Changes are collected and written in bulk at the end
+        events = []
+        new_alerts = []
+        updated_alerts = []
+        queued_alerts = []
+        
+        # Next run times (or run horizons) are calculated once per distinct schedule and timezone: next run times for
+        # jobs without run horizons in a single batch up front, and run horizons as jobs need them refilled
+        schedule_cache = next_runs(
+            ((job.schedule_str, job.user.timezone) for job in jobs if not job.uses_horizon()), now,
+        )
+        refilled = set()
+        
+        for job in jobs:
+            if job.id in missed_jobs:
+                # Error condition: the job did not send a notification
+                logger.debug(f"Alert! Job: {job} failed to notify in the time window")
+                
+                if job.failed:
+                    logger.debug(f"Skipped sending another alert for continually failing job {job}")
+                else:
+                    # Try alerting users in the relevant team
+                    if job.team is None:
+                        users = ((job.user, job.user.personal_alerts_on),)
+                    else:
+                        users = team_members[job.team_id]
+                    for user, alerts_on in users:
+                        alert = job_alerts.get((job.id, user.id))
+                        if alert is None:
+                            # Send an alert if it's our first
+                            new_alerts.append(JobAlert(user=user, job=job, last_alert=now))
+                        elif now > alert.last_alert + timedelta(minutes=user.alert_buffer):
+                            # Otherwise, decide whether to skip alerting based on the user's alert_buffer setting
+                            alert.last_alert = now
+                            updated_alerts.append(alert)
+                        else:
+                            logger.debug(f"Skipped alerting user '{user}' of failed job {job}")
+                            continue
+                        pending = self.queue_alert(user, job, alerts_on, now)
+                        if pending is not None:
+                            queued_alerts.append(pending)
+
+                job.last_failed = now
+                events.append(JobEvent(job=job, type=JobEvent.FAILURE, time=now))
+            
+            # Calculate the new next run time
+            if job.advance(now, schedule_cache):
+                refilled.add(job.id)
+        
+        # Jobs sharing a schedule and time window usually end up with identical new values, so each set of identical
+        # values can be written with a single statement (falling back to bulk_update if they're mostly different).
+        # Run horizons only need writing for jobs which had theirs recalculated.
+        job_updates = defaultdict(list)
+        for job in jobs:
+            run_horizon = job.run_horizon if job.id in refilled else None
+            job_updates[(job.next_run, job.deadline, job.last_failed, run_horizon)].append(job.id)
+        
+        with transaction.atomic():
+            if len(job_updates) * 10 <= len(jobs):
+                for (next_run, deadline, last_failed, run_horizon), ids in job_updates.items():
+                    values = {'next_run': next_run, 'deadline': deadline, 'last_failed': last_failed}
+                    if run_horizon is not None:
+                        values['run_horizon'] = run_horizon
+                    Job.objects.filter(id__in=ids).update(**values)
+            else:
+                fields = ['next_run', 'deadline', 'last_failed']
+                if refilled:
+                    fields.append('run_horizon')
+                Job.objects.bulk_update(jobs, fields)
+            JobEvent.objects.bulk_create(events)
+            JobAlert.objects.bulk_create(new_alerts)
+            JobAlert.objects.bulk_update(updated_alerts, ['last_alert'])
+            # Alerts are queued in the same transaction so they can't be lost (or sent for a failure that wasn't saved)
+            PendingAlert.objects.bulk_create(queued_alerts, ignore_conflicts=True)
+        counters.adjust(Counter((event.job.user_id, event.job.team_id) for event in events))
+        counters.touch({(job.user_id, job.team_id) for job in jobs})
         
-    def alert_user(self, user, job):        
+        if queued_alerts:
+            wake_dispatchers()
+        
+    def queue_alert(self, user, job, alerts_on, now):
         # Skip alerting if the user has alerts disabled (either globally or just for this team)
         if user.alert_method == User.NO_ALERTS:
             logger.debug(f"Not alerting user '{user}' as they have all alerts disabled")
-            return
-        if job.team is None:
-            alerts_on = user.personal_alerts_on
-        else:
-            alerts_on = TeamMembership.objects.get(user=user, team=job.team).alerts_on
+            return None
         if not alerts_on:
             logger.debug(f"Not alerting user '{user}' as they have alerts for team '{job.team}' disabled")
-            return
-        
-        # Either send an email or text based on user preferences
-        context = {'job': job, 'user': user, 'protocol': settings.SITE_PROTOCOL, 'domain': settings.SITE_DOMAIN}
-        if user.alert_method == User.EMAIL:
-            logger.debug(f"Sending user '{user}' an email at {user.email}")
-            subject = f"[CronTrack] ALERT: Job '{job.name}' failed to notify in time"
-            message = render_to_string('crontrack/email/alertuser.html', context)
-            user.email_user(subject, strip_tags(message), html_message=message)
-        else:
-            logger.debug(f"Sending user '{user}' an SMS at {user.phone}")
-            message = render_to_string('crontrack/sms/alertuser.txt', context)
-            client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-            try:
-                client.messages.create(body=message, to=str(user.phone), from_=settings.TWILIO_FROM_NUMBER)
-            except TwilioRestException:
-                logger.exception(f"Failed to send user '{user.username}' an SMS at {user.phone}")
+            return None
         
-        JobAlert.objects.get(job=job, user=user).last_alert = timezone.now()
-        job.save()
\ No newline at end of file
+        # The alert dispatcher sends it by email or text based on user preferences
+        logger.debug(f"Queueing alert to user '{user}' for job {job}")
+        return PendingAlert.for_failure(job, user, now)
@@ -0,0 +1,250 @@
+# Cached counts of each user's unseen job events (shown in the navbar on every page), kept up to date incrementally
+# as events are created, seen and deleted rather than counted on each page view.
+# Counts are stored in the cache given by settings.UNSEEN_COUNT_CACHE, which needs to be shared between processes
+# (e.g. memcached or Redis) for them to stay exact when the job monitor runs separately from the web server: with a
+# local memory cache they're counted from scratch on every page view instead.
+#
+# Each account (user and team) also has a change counter, bumped whenever any of its jobs or their events change,
+# which lets API clients polling for changes be told nothing has changed without running any queries (see api.py).
+# These are kept in settings.CHANGE_COUNTER_CACHE, and are only used if it's shared between processes: otherwise
+# changes made by the job monitor would go unnoticed, so API responses are sent without ETags instead.
+import random
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import Job, JobEvent, Team, TeamMembership, User
+
+LOCAL_CACHES = (DummyCache, LocMemCache)  # cache backends which aren't shared between processes
+
+
+def shared_cache(alias):
+    # Get the cache with the given alias (or the default), or None if it isn't shared between processes
+    cache = caches[alias or DEFAULT_CACHE_ALIAS]
+    return None if isinstance(cache, LOCAL_CACHES) else cache
+
+
+def get_cache():
+    return shared_cache(getattr(settings, 'UNSEEN_COUNT_CACHE', None))
+
+
+def get_timeout():
+    return getattr(settings, 'UNSEEN_COUNT_TIMEOUT', 60)
+
+
+def cache_key(user_id):
+    return f'crontrack:unseen:{user_id}'
+
+
+def get_changes_cache():
+    return shared_cache(getattr(settings, 'CHANGE_COUNTER_CACHE', None))
+
+
+def get_changes_timeout():
+    return getattr(settings, 'CHANGE_COUNTER_TIMEOUT', 60)
+
+
+def changes_key(account, id):
+    return f'crontrack:changes:{account}:{id}'
+
+
+def count_unseen(user):
+    # Count a user's unseen events from scratch
+    return user.all_accessible(JobEvent).filter(seen=False).count()
+
+
+def unseen_count(user):
+    cache = get_cache()
+    if cache is None:
+        return count_unseen(user)
+    count = cache.get(cache_key(user.id))
+    if count is None:
+        count = count_unseen(user)
+        # Don't overwrite a count another process has just cached (and maybe adjusted since)
+        cache.add(cache_key(user.id), count, get_timeout())
+    return max(count, 0)
+
+
+def job_viewers(jobs):
+    # Get the users with access to jobs, given as (owner ID, team ID) pairs. Returns a dict of each pair to a set of
+    # user IDs (the owner and the team's members), using a single query for all the teams.
+    members = {}
+    teams = {team_id for user_id, team_id in jobs if team_id is not None}
+    if teams:
+        for user_id, team_id in TeamMembership.objects.filter(team__in=teams).values_list('user', 'team'):
+            members.setdefault(team_id, set()).add(user_id)
+    return {(user_id, team_id): {user_id} | members.get(team_id, set()) for user_id, team_id in jobs}
+
+
+def adjust(counts, sign=1):
+    # Add (or with sign=-1, subtract) events to the cached counts of everyone who can see them, where counts is a dict
+    # of (job owner ID, job team ID) pairs to the number of unseen events. Users with no cached count are skipped, as
+    # they'll be counted from scratch when next needed.
+    cache = get_cache()
+    if cache is None:
+        return
+    counts = {job: count for job, count in counts.items() if count}
+    changes = Counter()
+    for job, users in job_viewers(counts).items():
+        for user_id in users:
+            changes[user_id] += counts[job]
+
+    for user_id, change in changes.items():
+        change *= sign
+        try:
+            if change > 0:
+                cache.incr(cache_key(user_id), change)
+            elif change < 0:
+                cache.decr(cache_key(user_id), -change)
+        except ValueError:
+            # Not cached
+            pass
+
+
+def event_counts(events):
+    # Group a queryset of events into the counts taken by adjust()
+    grouped = events.order_by().values_list('job__user', 'job__team').annotate(count=Count('id'))
+    return {(user_id, team_id): count for user_id, team_id, count in grouped}
+
+
+def mark_seen(events):
+    # Mark a queryset of events as seen with a single update, taking them off the counts of everyone who can see them
+    counts = event_counts(events.filter(seen=False))
+    updated = events.filter(seen=False).update(seen=True)
+    touch(counts)
+    if updated == sum(counts.values()):
+        adjust(counts, -1)
+    else:
+        # Something else changed the events in between, so the counts affected are recounted instead
+        forget_jobs(counts)
+    return updated
+
+
+def forget(user_ids):
+    # Drop users' cached counts (once the current transaction commits), for them to be counted from scratch
+    keys = [cache_key(user_id) for user_id in user_ids]
+    if keys and get_cache() is not None:
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+def forget_jobs(jobs):
+    # Drop the cached counts of everyone with access to jobs, given as (owner ID, team ID) pairs
+    forget(set().union(*job_viewers(jobs).values()))
+
+
+def recount(user_ids=None):
+    # Rebuild the cached counts of the given users (or everyone) from scratch, returning a dict of user IDs to counts.
+    # Uses a fixed number of queries however many users there are.
+    unseen = JobEvent.objects.filter(seen=False).order_by()
+    counts = Counter(dict(unseen.values_list('job__user').annotate(Count('id'))))
+    by_team = dict(unseen.filter(job__team__isnull=False).values_list('job__team').annotate(Count('id')))
+    for user_id, team_id in set(TeamMembership.objects.values_list('user', 'team')):
+        counts[user_id] += by_team.get(team_id, 0)
+    # Events for jobs in one of their owner's own teams were counted twice
+    counts.subtract(dict(
+        unseen
+        .filter(job__team__teammembership__user=F('job__user'))
+        .values_list('job__user')
+        .annotate(Count('id', distinct=True))
+    ))
+
+    users = User.objects.all()
+    if user_ids is not None:
+        users = users.filter(id__in=user_ids)
+    counts = {user_id: counts[user_id] for user_id in users.values_list('id', flat=True)}
+    cache = get_cache()
+    if cache is not None:
+        cache.set_many({cache_key(user_id): count for user_id, count in counts.items()}, get_timeout())
+    return counts
+
+
+def touch(jobs):
+    # Bump the change counters of the owners and teams of jobs, given as (owner ID, team ID) pairs, once the current
+    # transaction commits. Counters which aren't cached are left to start again when next needed.
+    keys = set()
+    for user_id, team_id in jobs:
+        keys.add(changes_key('user', user_id))
+        if team_id is not None:
+            keys.add(changes_key('team', team_id))
+    if keys and get_changes_cache() is not None:
+        transaction.on_commit(lambda: bump(keys))
+
+
+def bump(keys):
+    cache = get_changes_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Not cached
+            pass
+
+
+def version(user):
+    # Get a token which changes whenever any job or event the user can see changes (or they join or leave a team), made
+    # from the change counters of the user and their teams. Returns None unless the counters are in a shared cache.
+    cache = get_changes_cache()
+    if cache is None:
+        return None
+    keys = [changes_key('user', user.id)] + [changes_key('team', team_id) for team_id in sorted(user.memberships())]
+    values = cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        # Start from a random value, so tokens from before a counter was lost (or expired) don't match new ones
+        for key in missing:
+            cache.add(key, random.getrandbits(48), get_changes_timeout())
+        values.update(cache.get_many(missing))
+        if len(values) < len(keys):
+            return None
+    return ','.join(f'{key}={values[key]}' for key in keys)
+
+
+# Changes to which jobs (and so events) users can see invalidate the counts affected, and all changes to jobs bump
+# their change counters
+
+@receiver(post_save, sender=TeamMembership)
+def membership_saved(sender, instance, created, **kwargs):
+    if created:
+        forget([instance.user_id])
+
+
+@receiver(post_delete, sender=TeamMembership)
+def membership_deleted(sender, instance, **kwargs):
+    forget([instance.user_id])
+
+
+@receiver(pre_delete, sender=Team)
+def team_deleted(sender, instance, **kwargs):
+    # The team's jobs become personal jobs, visible to their owners even if they weren't in the team
+    jobs = set(Job.objects.filter(team=instance).values_list('user', 'team'))
+    forget({user_id for user_id, team_id in jobs})
+    touch(jobs)
+
+
+@receiver(pre_save, sender=Job)
+def job_saved(sender, instance, update_fields=None, **kwargs):
+    if instance._state.adding or (update_fields is not None and not {'user', 'team'} & set(update_fields)):
+        return
+    old = Job.objects.filter(pk=instance.pk).values_list('user', 'team').first()
+    new = (instance.user_id, instance.team_id)
+    if old is not None and old != new:
+        forget_jobs([old, new])
+        touch([old])
+
+
+@receiver(post_save, sender=Job)
+def job_changed(sender, instance, **kwargs):
+    touch([(instance.user_id, instance.team_id)])
+
+
+@receiver(post_delete, sender=Job)
+def job_deleted(sender, instance, **kwargs):
+    forget_jobs([(instance.user_id, instance.team_id)])
+    touch([(instance.user_id, instance.team_id)])
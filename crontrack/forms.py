@@ -21,4 +21,6 @@ class ProfileForm(forms.Form):
     )
     email = forms.EmailField(label='Email address', required=False)
     full_phone = PhoneNumberField(label='Phone number', required=False)
-    alert_buffer = forms.IntegerField()
\ No newline at end of file
+    alert_buffer = forms.IntegerField()
+    alert_digest = forms.BooleanField(required=False)
+    digest_window = forms.IntegerField(min_value=0)
\ No newline at end of file
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from crontrack.retention import BATCH_SIZE, archive_events, retention_cutoff
+
+
+class Command(BaseCommand):
+    help = "Roll up events older than the retention period into daily summaries, and delete them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', '-d',
+            type=int,
+            default=None,
+            dest='days',
+            help="Number of days of events to keep. Defaults to the EVENT_RETENTION_DAYS setting.",
+        )
+        parser.add_argument(
+            '--batch-size', '-b',
+            type=int,
+            default=BATCH_SIZE,
+            dest='batch-size',
+            help=f"Number of events to archive in each transaction. Defaults to {BATCH_SIZE}.",
+        )
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else getattr(settings, 'EVENT_RETENTION_DAYS', None)
+        if days is None:
+            raise CommandError("No retention period: set EVENT_RETENTION_DAYS or use --days")
+        if days < 0 or options['batch-size'] <= 0:
+            raise CommandError("Days must not be negative and the batch size must be positive")
+
+        archived = archive_events(retention_cutoff(days=days), batch_size=options['batch-size'])
+        self.stdout.write(f"Archived {archived} event(s) older than {days} day(s)")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from crontrack.counters import recount
+
+
+class Command(BaseCommand):
+    help = "Rebuild the cached counts of unseen events shown to each user from scratch."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', '-u',
+            type=int,
+            action='append',
+            default=None,
+            dest='users',
+            help="ID of a user to recount (can be given more than once). Defaults to every user.",
+        )
+
+    def handle(self, *args, **options):
+        counts = recount(options['users'])
+        self.stdout.write(f"Recounted unseen events for {len(counts)} user(s)")
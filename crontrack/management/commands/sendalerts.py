@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from crontrack.alerts import AlertDispatcher
+
+class Command(BaseCommand):
+    help = "Start the alert dispatcher, which sends the alerts queued by the job monitor."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--run-for', '-s',
+            type=int,
+            default=None,
+            dest='run-for',
+            help="Time to run for in seconds. Defaults to forever.",
+        )
+        parser.add_argument(
+            '--workers', '-w',
+            type=int,
+            default=None,
+            dest='workers',
+            help="Number of threads to send alerts with. Defaults to the ALERT_WORKERS setting.",
+        )
+        
+    def handle(self, *args, **options):
+        try:
+            dispatcher = AlertDispatcher(options['run-for'], threaded=False, workers=options['workers'])
+        except ValueError as e:
+            raise CommandError(str(e))
@@ -1,6 +1,16 @@
+import multiprocessing
+
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
+from crontrack.alerts import AlertDispatcher
 from crontrack.background import JobMonitor
+from crontrack.models import Job
+
+
+def run_worker(options):
+    JobMonitor(options['run-for'], threaded=False, event_driven=options['event-driven'], sharded=True)
+
 
 class Command(BaseCommand):
     help = "Start the job monitor."
@@ -13,9 +23,61 @@ class Command(BaseCommand):
             dest='run-for',
             help="Time to run for in seconds. Defaults to forever.",
         )
+        parser.add_argument(
+            '--event-driven', '-e',
+            action='store_true',
+            dest='event-driven',
+            help="Sleep until the next job is due instead of checking jobs every minute.",
+        )
+        parser.add_argument(
+            '--workers', '-w',
+            type=int,
+            default=None,
+            dest='workers',
+            help=(
+                "Number of worker processes to split the jobs between. Workers share the jobs with any other "
+                "monitors started with this option (including on other hosts). Defaults to a single unsharded monitor."
+            ),
+        )
+        parser.add_argument(
+            '--no-dispatcher',
+            action='store_true',
+            dest='no-dispatcher',
+            help="Don't send queued alerts from this process (use the sendalerts command instead).",
+        )
         
     def handle(self, *args, **options):
-        try:
-            monitor = JobMonitor(options['run-for'])
-        except ValueError as e:
-            raise CommandError(str(e))
\ No newline at end of file
+        workers = options['workers']
+        if workers is None:
+            try:
+                if not options['no-dispatcher']:
+                    dispatcher = AlertDispatcher(options['run-for'], threaded=True)
+                monitor = JobMonitor(options['run-for'], threaded=False, event_driven=options['event-driven'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            return
+        
+        if not 1 <= workers <= Job.SHARD_COUNT:
+            raise CommandError(f"Number of workers must be between 1 and {Job.SHARD_COUNT}")
+        if options['run-for'] is not None and options['run-for'] <= 0:
+            raise CommandError("Time limit must be a positive number of seconds or None")
+        
+        if workers == 1:
+            if not options['no-dispatcher']:
+                dispatcher = AlertDispatcher(options['run-for'], threaded=True)
+            run_worker(options)
+            return
+        
+        # Don't share database connections with the worker processes
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(options,), name=f'JobMonitorWorker{i}')
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        # Only start sending alerts after forking, so the worker processes don't inherit the dispatcher's threads
+        if not options['no-dispatcher']:
+            dispatcher = AlertDispatcher(options['run-for'], threaded=True)
+        for process in processes:
+            process.join()
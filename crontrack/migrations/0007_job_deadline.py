@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def set_deadlines(apps, schema_editor):
+    Job = apps.get_model('crontrack', 'Job')
+    for job in Job.objects.all():
+        job.deadline = job.next_run + timedelta(minutes=job.time_window)
+        job.save(update_fields=['deadline'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0006_auto_20190222_1618'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='next_run',
+            field=models.DateTimeField(db_index=True, verbose_name='next time to run'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='deadline',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='next run time plus time window'),
+        ),
+        migrations.RunPython(set_deadlines, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='job',
+            name='deadline',
+            field=models.DateTimeField(db_index=True, editable=False, verbose_name='next run time plus time window'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+SHARD_COUNT = 64
+
+
+def set_shards(apps, schema_editor):
+    Job = apps.get_model('crontrack', 'Job')
+    MonitorLease = apps.get_model('crontrack', 'MonitorLease')
+    for job in Job.objects.all():
+        job.shard = job.id.int % SHARD_COUNT
+        job.save(update_fields=['shard'])
+    MonitorLease.objects.bulk_create(MonitorLease(shard=shard) for shard in range(SHARD_COUNT))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0007_job_deadline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitorLease',
+            fields=[
+                ('shard', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('owner', models.CharField(blank=True, default='', max_length=100)),
+                ('expires', models.DateTimeField(blank=True, null=True, verbose_name='time the lease expires')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MonitorWorker',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('expires', models.DateTimeField(verbose_name='time the worker is considered dead')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='job monitor partition'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['shard', 'deadline'], name='crontrack_j_shard_f05a21_idx'),
+        ),
+        migrations.RunPython(set_shards, migrations.RunPython.noop),
+    ]
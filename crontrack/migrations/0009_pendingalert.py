@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0008_job_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAlert',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True, verbose_name='idempotency key')),
+                ('run_time', models.DateTimeField(verbose_name='run time the job missed')),
+                ('created', models.DateTimeField()),
+                ('next_attempt', models.DateTimeField(verbose_name='next time to try sending')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('claim', models.CharField(blank=True, default='', max_length=100, verbose_name='dispatcher currently sending')),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('error', models.CharField(blank=True, default='', max_length=200, verbose_name='last error sending')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crontrack.job')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pendingalert',
+            index=models.Index(fields=['sent', 'next_attempt'], name='crontrack_p_sent_0323e0_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0009_pendingalert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='alert_digest',
+            field=models.BooleanField(default=False, verbose_name='combine alerts for several jobs into one message'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='digest_window',
+            field=models.PositiveIntegerField(default=0, verbose_name='time to collect alerts for before sending a digest (min)'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0010_user_alert_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='run_horizon',
+            field=models.BinaryField(default=b'', verbose_name='upcoming run times'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+def set_has_warning(apps, schema_editor):
+    Job = apps.get_model('crontrack', 'Job')
+    Job.objects.filter(events__type='W').update(has_warning=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0011_job_run_horizon'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='has_warning',
+            field=models.BooleanField(default=False, editable=False, verbose_name='has warning events'),
+        ),
+        migrations.RunPython(set_has_warning, migrations.RunPython.noop),
+    ]
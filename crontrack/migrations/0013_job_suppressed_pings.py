@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0012_job_has_warning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='suppressed_pings',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='notifications rejected by rate limiting'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0013_job_suppressed_pings'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(condition=models.Q(('last_failed__isnull', True)), fields=['next_run'], name='job_running_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(condition=models.Q(('last_failed__isnull', False)), fields=['last_failed'], name='job_failed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='jobevent',
+            index=models.Index(fields=['job', 'type'], name='jobevent_job_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='jobevent',
+            index=models.Index(fields=['job', 'seen', 'time'], name='jobevent_job_seen_time_idx'),
+        ),
+        # The foreign key's own index is dropped last, as MySQL needs another index on job_id to exist first
+        migrations.AlterField(
+            model_name='jobevent',
+            name='job',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='events', to='crontrack.job'),
+        ),
+    ]
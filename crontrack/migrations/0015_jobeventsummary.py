@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0014_event_and_job_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobEventSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('warnings', models.PositiveIntegerField(default=0)),
+                ('first', models.DateTimeField(verbose_name='time of the first event')),
+                ('last', models.DateTimeField(verbose_name='time of the last event')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='jobevent',
+            index=models.Index(fields=['time'], name='jobevent_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='jobeventsummary',
+            name='job',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='event_summaries', to='crontrack.job'),
+        ),
+        migrations.AddConstraint(
+            model_name='jobeventsummary',
+            constraint=models.UniqueConstraint(fields=('job', 'date'), name='jobeventsummary_job_date'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0015_jobeventsummary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='name',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['team', 'group'], name='job_team_group_idx'),
+        ),
+        # The foreign key's own index is dropped last, as MySQL needs another index on team_id to exist first
+        migrations.AlterField(
+            model_name='job',
+            name='team',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='crontrack.team'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crontrack', '0016_job_name_and_team_group_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='job',
+            name='job_running_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='job',
+            name='job_failed_idx',
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['last_failed', 'next_run'], name='job_failed_next_run_idx'),
+        ),
+    ]
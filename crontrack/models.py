@@ -1,43 +1,168 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 import uuid
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.core.exceptions import FieldError
-from django.db import models
-from django.db.models import Q
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import models, transaction
+from django.db.models import Case, CharField, F, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.template.defaultfilters import date, time
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.http import urlencode
 from phonenumber_field.modelfields import PhoneNumberField
 from timezone_field import TimeZoneField
 
+from .schedule import make_horizon, next_from_horizon, next_run, supports_horizon
 
-class JobManager(models.Manager):
+
+# Failed jobs are found with a range on last_failed (which is always after this) rather than IS NOT NULL, which not
+# every database can search an index for
+FAILED_SINCE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class JobQuerySet(models.QuerySet):
     def running(self):
-        return self.get_queryset().filter(last_failed__isnull=True)
+        return self.filter(last_failed__isnull=True)
 
     def failed(self):
-        return self.get_queryset().filter(last_failed__isnull=False)
+        return self.filter(last_failed__gte=FAILED_SINCE)
+
+    # Annotate each job's status (one of Job.STATUS_CHOICES) as at now, the same way as Job.failed and Job.failing.
+    # Every row is evaluated against the same time, so statuses can be counted and sorted consistently.
+    def with_status(self, now=None):
+        failed, failing = status_conditions(now)
+        return self.annotate(status=Case(
+            When(failed, then=Value(Job.FAILED)),
+            When(failing, then=Value(Job.FAILING)),
+            default=Value(Job.OK),
+            output_field=CharField(),
+        ))
+
+    # Filter jobs by status as at now. Uses the conditions with_status() is calculated from directly rather than
+    # comparing the annotation, so the database can use its indexes.
+    def filter_status(self, status, now=None):
+        failed, failing = status_conditions(now)
+        if status == Job.FAILED:
+            return self.filter(failed)
+        elif status == Job.FAILING:
+            return self.filter(failing)
+        elif status == Job.OK:
+            return self.exclude(failed).exclude(failing)
+        raise ValueError(f"Unknown job status '{status}'")
+
+
+def status_conditions(now=None):
+    # Get the (failed, failing) conditions for a job's status as at now
+    if now is None:
+        now = timezone.now()
+    failed = Q(last_failed__gte=FAILED_SINCE)
+    failing = (
+        Q(last_failed__isnull=True, next_run__lt=now) &
+        (Q(last_notified__isnull=True) | Q(last_notified__lt=F('next_run')))
+    )
+    return failed, failing
 
 
 class Job(models.Model):
+    SHARD_COUNT = 64  # number of partitions jobs are split into between job monitor workers
+    OK = 'ok'
+    FAILING = 'failing'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (OK, 'OK'),
+        (FAILING, 'Failing'),
+        (FAILED, 'Failed'),
+    )
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     schedule_str = models.CharField('cron schedule string', max_length=100)
-    name = models.CharField(max_length=50)
+    name = models.CharField(max_length=50, db_index=True)
     description = models.CharField(max_length=200, blank=True, default='')
     time_window = models.PositiveIntegerField('time window (minutes)', default=0)
-    next_run = models.DateTimeField('next time to run')
+    next_run = models.DateTimeField('next time to run', db_index=True)
+    deadline = models.DateTimeField('next run time plus time window', db_index=True, editable=False)
+    shard = models.PositiveSmallIntegerField('job monitor partition', default=0, editable=False)
+    run_horizon = models.BinaryField('upcoming run times', default=b'', editable=False)
+    has_warning = models.BooleanField('has warning events', default=False, editable=False)
+    suppressed_pings = models.PositiveIntegerField('notifications rejected by rate limiting', default=0, editable=False)
     last_failed = models.DateTimeField('last time job failed to notify', null=True, blank=True)
     last_notified = models.DateTimeField('last time notification received', null=True, blank=True)
     
     user = models.ForeignKey('User', models.CASCADE)
     group = models.ForeignKey('JobGroup', models.CASCADE, null=True, blank=True)
-    team = models.ForeignKey('Team', models.SET_NULL, null=True, blank=True)
+    team = models.ForeignKey('Team', models.SET_NULL, null=True, blank=True, db_index=False)
     alerted_users = models.ManyToManyField('User', through='JobAlert', related_name='job_alert_set')
 
-    objects = JobManager()
+    objects = JobQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard', 'deadline']),
+            # Running jobs (last_failed is NULL) by next run time and failed jobs by failure time, for the monitor's
+            # warning checks and the managers' queries (a plain index, as MySQL doesn't support partial ones)
+            models.Index(fields=['last_failed', 'next_run'], name='job_failed_next_run_idx'),
+            # Each team's groups and ungrouped jobs, for the view jobs page (and lookups by team alone)
+            models.Index(fields=['team', 'group'], name='job_team_group_idx'),
+        ]
     
     def __str__(self):
         return f"({self.team}) {self.user}'s {self.name}: '{self.schedule_str}'"
+    
+    # Link to the job on the view jobs page, showing only its group
+    def get_absolute_url(self):
+        query = urlencode({'team': self.team_id or 'None', 'group': self.group_id or 'None'})
+        return f"{reverse('crontrack:view_jobs')}?{query}#{self.id}"
+
+    # Set next_run and the deadline together (for bulk updates, which skip save())
+    def set_next_run(self, next_run):
+        self.next_run = next_run
+        self.deadline = next_run + timedelta(minutes=self.time_window)
+    
+    # Move next_run on to the next run time after now, taking it from the job's run horizon (its next few run times,
+    # recalculated when used up or when the schedule or owner's timezone changes) if enabled in settings and the
+    # schedule has no seconds field.
+    # cache can be a dict shared between calls with the same now, to reuse the calculations for jobs with the same
+    # schedule and timezone (and can be filled in advance with next_runs() for jobs without run horizons).
+    # Returns True if run_horizon was changed and needs saving.
+    def advance(self, now, cache=None):
+        size = getattr(settings, 'JOB_RUN_HORIZON', 0)
+        tz = self.user.timezone
+        key = (self.schedule_str, tz)
+        if cache is None:
+            cache = {}
+        
+        if not self.uses_horizon():
+            if key not in cache:
+                cache[key] = next_run(self.schedule_str, now.astimezone(tz))
+            self.set_next_run(cache[key])
+            return False
+        
+        run = next_from_horizon(self.run_horizon, self.schedule_str, tz, now)
+        if run is not None:
+            self.set_next_run(run)
+            return False
+        
+        if key not in cache:
+            cache[key] = make_horizon(self.schedule_str, tz, now, size)
+        self.run_horizon = cache[key]
+        self.set_next_run(next_from_horizon(self.run_horizon, self.schedule_str, tz, now))
+        return True
+    
+    # Whether the job's next run times come from its run horizon (if enabled, and the schedule has no seconds field)
+    def uses_horizon(self):
+        return bool(getattr(settings, 'JOB_RUN_HORIZON', 0)) and supports_horizon(self.schedule_str)
+    
+    def save(self, *args, **kwargs):
+        # Keep the deadline in sync with next_run so the job monitor can find due jobs with an indexed query
+        self.deadline = self.next_run + timedelta(minutes=self.time_window)
+        self.shard = self.id.int % self.SHARD_COUNT
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'deadline' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['deadline']
+        super().save(*args, **kwargs)
 
     @property
     def failed(self):
@@ -54,6 +179,25 @@ class Job(models.Model):
         )
 
 
+class MonitorLease(models.Model):
+    # Records which job monitor worker is responsible for each shard of jobs, and until when
+    shard = models.PositiveSmallIntegerField(primary_key=True)
+    owner = models.CharField(max_length=100, blank=True, default='')
+    expires = models.DateTimeField('time the lease expires', null=True, blank=True)
+    
+    def __str__(self):
+        return f"Shard {self.shard} leased by '{self.owner}' until {self.expires}"
+
+
+class MonitorWorker(models.Model):
+    # Heartbeat for a sharded job monitor worker, so shards can be shared fairly between all live workers
+    name = models.CharField(max_length=100, primary_key=True)
+    expires = models.DateTimeField('time the worker is considered dead')
+    
+    def __str__(self):
+        return self.name
+
+
 class JobGroup(models.Model):
     name = models.CharField(max_length=50)
     description = models.CharField(max_length=200, blank=True, default='')
@@ -70,6 +214,36 @@ class JobAlert(models.Model):
     last_alert = models.DateTimeField('last time alert sent', null=True, blank=True)
 
 
+class PendingAlert(models.Model):
+    # An outgoing alert queued by the job monitor, to be sent (and retried if needed) by the alert dispatcher
+    key = models.CharField('idempotency key', max_length=100, unique=True)
+    job = models.ForeignKey('Job', models.CASCADE)
+    user = models.ForeignKey('User', models.CASCADE)
+    run_time = models.DateTimeField('run time the job missed')
+    created = models.DateTimeField()
+    next_attempt = models.DateTimeField('next time to try sending')
+    attempts = models.PositiveIntegerField(default=0)
+    claim = models.CharField('dispatcher currently sending', max_length=100, blank=True, default='')
+    sent = models.DateTimeField(null=True, blank=True)
+    error = models.CharField('last error sending', max_length=200, blank=True, default='')
+    
+    class Meta:
+        indexes = [models.Index(fields=['sent', 'next_attempt'])]
+    
+    def __str__(self):
+        return f"Alert for {self.user} about {self.job.name} at {self.run_time}"
+    
+    @classmethod
+    def for_failure(cls, job, user, now):
+        # Create an alert for a job failing to run at its current next_run, keyed so it can only be queued once.
+        # Users getting digests have their alerts held for their digest window to collect other failures with it.
+        key = f'{job.id}:{user.id}:{int(job.next_run.timestamp())}'
+        next_attempt = now
+        if user.alert_digest:
+            next_attempt += timedelta(minutes=user.digest_window)
+        return cls(key=key, job=job, user=user, run_time=job.next_run, created=now, next_attempt=next_attempt)
+
+
 class JobEvent(models.Model):
     FAILURE = 'F'
     WARNING = 'W'
@@ -77,13 +251,39 @@ class JobEvent(models.Model):
         (FAILURE, 'Failure'),
         (WARNING, 'Warning'),
     )
-    job = models.ForeignKey('Job', models.CASCADE, related_name='events')
+    # The indexes below start with job, so the foreign key doesn't need one of its own
+    job = models.ForeignKey('Job', models.CASCADE, related_name='events', db_index=False)
     type = models.CharField(max_length=1, choices=TYPE_CHOICES, default=FAILURE)
     time = models.DateTimeField()
     seen = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['-time']
+        indexes = [
+            # Finding (and deleting) a job's warnings
+            models.Index(fields=['job', 'type'], name='jobevent_job_type_idx'),
+            # Counting a job's unseen events and listing its events by time
+            models.Index(fields=['job', 'seen', 'time'], name='jobevent_job_seen_time_idx'),
+            # Finding the oldest events to archive
+            models.Index(fields=['time'], name='jobevent_time_idx'),
+        ]
+
+
+class JobEventSummary(models.Model):
+    # A day's events for a job rolled up into counts, once they're older than settings.EVENT_RETENTION_DAYS
+    # (see crontrack.retention). Days are in UTC.
+    job = models.ForeignKey('Job', models.CASCADE, related_name='event_summaries', db_index=False)
+    date = models.DateField()
+    failures = models.PositiveIntegerField(default=0)
+    warnings = models.PositiveIntegerField(default=0)
+    first = models.DateTimeField('time of the first event')
+    last = models.DateTimeField('time of the last event')
+    
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['job', 'date'], name='jobeventsummary_job_date')]
+    
+    def __str__(self):
+        return f"{self.job.name} on {self.date}: {self.failures} failure(s), {self.warnings} warning(s)"
 
 
 class User(AbstractUser):
@@ -98,22 +298,44 @@ class User(AbstractUser):
     timezone = TimeZoneField(default='UTC')
     alert_method = models.CharField(max_length=1, choices=ALERT_METHOD_CHOICES, default=NO_ALERTS)
     alert_buffer = models.IntegerField('time to wait between alerts (min)', default=1440)
+    alert_digest = models.BooleanField('combine alerts for several jobs into one message', default=False)
+    digest_window = models.PositiveIntegerField('time to collect alerts for before sending a digest (min)', default=0)
     personal_alerts_on = models.BooleanField('alerts on for jobs without a team', default=True)
     phone = PhoneNumberField(blank=True)
     email = models.EmailField(unique=True, max_length=100)
     teams = models.ManyToManyField('Team', through='TeamMembership')
     
+    # Get this user's team memberships as a dict of team IDs to whether they have alerts on for the team.
+    # Loaded once per instance (so once per request for request.user), and shared between requests through the cache
+    # for settings.MEMBERSHIP_CACHE_TIMEOUT seconds if set. Both are invalidated when the user's memberships change.
+    def memberships(self):
+        cached = getattr(self, '_memberships', None)
+        if cached is not None and cached[0] == _membership_generation:
+            return cached[1]
+        
+        generation = _membership_generation
+        timeout = getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 0)
+        memberships = membership_cache().get(membership_key(self.id)) if timeout else None
+        if memberships is None:
+            memberships = dict(TeamMembership.objects.filter(user=self).values_list('team', 'alerts_on'))
+            if timeout:
+                membership_cache().set(membership_key(self.id), memberships, timeout)
+        self._memberships = (generation, memberships)
+        return memberships
+    
     # Check if this user has access to an instance of a model (either Job or JobGroup)
     def can_access(self, instance):
-        return instance.user == self or instance.team in self.teams.all()
+        if instance.user_id == self.id:
+            return True
+        return instance.team_id is not None and instance.team_id in self.memberships()
     
     # Get all instances of a model this user has access to
     def all_accessible(self, model):
-        try:
-            return model.objects.filter(Q(user=self) | Q(team__in=self.teams.all()))
-        except FieldError:
-            # The model is connected to the user indirectly e.g. through a job like JobEvent
-            return model.objects.filter(Q(job__user=self) | Q(job__team__in=self.teams.all()))
+        teams = list(self.memberships())
+        if any(field.name == 'team' for field in model._meta.get_fields()):
+            return model.objects.filter(Q(user=self) | Q(team__in=teams))
+        # The model is connected to the user indirectly e.g. through a job like JobEvent
+        return model.objects.filter(Q(job__user=self) | Q(job__team__in=teams))
 
 
 class Team(models.Model):
@@ -127,4 +349,29 @@ class Team(models.Model):
 class TeamMembership(models.Model):
     user = models.ForeignKey('User', models.CASCADE)
     team = models.ForeignKey('Team', models.CASCADE)
-    alerts_on = models.BooleanField(default=True)
\ No newline at end of file
+    alerts_on = models.BooleanField(default=True)
+
+
+# Team memberships cached by User.memberships()
+# Bumped whenever a membership changes in this process, so memberships cached on User instances are reloaded
+_membership_generation = 0
+
+
+def membership_cache():
+    return caches[getattr(settings, 'MEMBERSHIP_CACHE', None) or DEFAULT_CACHE_ALIAS]
+
+
+def membership_key(user_id):
+    return f'crontrack:memberships:{user_id}'
+
+
+@receiver(post_save, sender=TeamMembership)
+@receiver(post_delete, sender=TeamMembership)
+def membership_changed(sender, instance, **kwargs):
+    global _membership_generation
+    _membership_generation += 1
+    if getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 0):
+        key = membership_key(instance.user_id)
+        membership_cache().delete(key)
+        # And again once committed, in case it was cached from another transaction in between
+        transaction.on_commit(lambda: membership_cache().delete(key))
\ No newline at end of file
@@ -0,0 +1,438 @@
+# Job notifications (recording the pings jobs send each time they run)
+import asyncio
+import atexit
+import glob
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import counters
+from .background import reschedule_job
+from .models import Job, JobEvent
+
+logger = logging.getLogger(__name__)
+
+# Only the fields needed to work out a job's new next run time are loaded when it's notified
+NOTIFY_FIELDS = (
+    'schedule_str', 'time_window', 'next_run', 'shard', 'run_horizon', 'has_warning', 'team', 'user__timezone',
+)
+BULK_FIELDS = NOTIFY_FIELDS + ('last_notified',)
+MAX_BULK_PINGS = 1000  # maximum number of jobs which can be notified in a single request
+BUFFER_MODES = (None, 'memory', 'spool')
+KNOWN_JOBS_SIZE = 100000  # maximum number of job IDs to remember as existing when buffering pings
+RATE_LIMIT_SIZE = 100000  # number of jobs to track rate limits (and suppressed pings) for, forgetting the oldest
+
+
+def record_ping(job, now):
+    # Apply a ping to a loaded job, returning True if its run horizon was recalculated
+    refilled = job.advance(now)
+    job.last_notified = now
+    job.last_failed = None
+    return refilled
+
+
+def notify(id, now=None):
+    # Update a job's last_notified, last_failed, and next_run, returning the job (or None if there's no such job)
+    if now is None:
+        now = timezone.now()
+    try:
+        job = Job.objects.select_related('user').only('user', *NOTIFY_FIELDS).get(pk=id)
+    except Job.DoesNotExist:
+        return None
+    
+    values = {'last_notified': now, 'last_failed': None}
+    suppressed = take_suppressed(id)
+    if suppressed:
+        values['suppressed_pings'] = F('suppressed_pings') + suppressed
+    if record_ping(job, now):
+        values['run_horizon'] = job.run_horizon
+    values.update(next_run=job.next_run, deadline=job.deadline)
+    
+    if job.has_warning:
+        # Delete the JobEvent warning(s), which the flag saves looking for on every ping
+        values['has_warning'] = job.has_warning = False
+        warnings = JobEvent.objects.filter(job=job, type=JobEvent.WARNING)
+        with transaction.atomic():
+            Job.objects.filter(pk=id).update(**values)
+            unseen = warnings.filter(seen=False).delete()[0]
+            warnings.delete()
+        counters.adjust({(job.user_id, job.team_id): unseen}, -1)
+    else:
+        Job.objects.filter(pk=id).update(**values)
+    counters.touch([(job.user_id, job.team_id)])
+    reschedule_job(job)
+    
+    logger.debug(f"Notified for job '{id}' at {now}")
+    return job
+
+
+def notify_many(pings):
+    # Batched version of notify: takes a dict of job IDs to ping times, and returns a dict of job IDs to jobs for
+    # those which exist. Uses a constant number of queries regardless of the number of jobs.
+    found = list(Job.objects.select_related('user').only('user', *BULK_FIELDS).filter(id__in=list(pings)))
+    # Pings older than a job's last notification (e.g. sent late with their original time) don't change anything
+    jobs = [job for job in found if job.last_notified is None or job.last_notified < pings[job.id]]
+    fields = ['last_notified', 'last_failed', 'next_run', 'deadline']
+    if any([record_ping(job, pings[job.id]) for job in jobs]):
+        fields.append('run_horizon')
+    warned = [job for job in jobs if job.has_warning]
+    for job in warned:
+        job.has_warning = False
+    if warned:
+        fields.append('has_warning')
+    suppressed = {job.id: take_suppressed(job.id) for job in jobs}
+    if any(suppressed.values()):
+        for job in jobs:
+            job.suppressed_pings = F('suppressed_pings') + suppressed[job.id]
+        fields.append('suppressed_pings')
+    
+    warnings = JobEvent.objects.filter(job__in=warned, type=JobEvent.WARNING)
+    with transaction.atomic():
+        Job.objects.bulk_update(jobs, fields, batch_size=500)
+        unseen = counters.event_counts(warnings.filter(seen=False)) if warned else {}
+        warnings.delete()
+    counters.adjust(unseen, -1)
+    counters.touch({(job.user_id, job.team_id) for job in jobs})
+    for job in jobs:
+        reschedule_job(job)
+    
+    logger.debug(f"Notified for {len(jobs)} job(s)")
+    return {job.id: job for job in found}
+
+
+# Rate limiting (see settings.PING_RATE_LIMIT): pings for a job beyond the limit are rejected before they reach the
+# database, and counted so the number suppressed can be added to the job's suppressed_pings with its next ping
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    # Get this process's rate limiter (or None if pings aren't limited), starting a new one if the settings change
+    global _rate_limiter
+    config = (
+        getattr(settings, 'PING_RATE_LIMIT', None),
+        getattr(settings, 'PING_RATE_BURST', 1),
+        getattr(settings, 'PING_RATE_CACHE', None),
+    )
+    if config[0] is None:
+        return None
+    with _rate_limiter_lock:
+        if _rate_limiter is None or _rate_limiter.config != config:
+            _rate_limiter = RateLimiter(*config)
+        return _rate_limiter
+
+
+def allow_ping(id):
+    # Check whether a ping for a job is within its rate limit (counting it as suppressed if not)
+    limiter = get_rate_limiter()
+    return limiter is None or limiter.allow(id)
+
+
+def take_suppressed(id):
+    # Get (and reset) the number of pings for a job suppressed by this process since it was last notified
+    limiter = get_rate_limiter()
+    return 0 if limiter is None else limiter.take_suppressed(id)
+
+
+class RateLimiter:
+    # Token buckets limiting each job to rate pings per minute on average, allowing up to burst at once.
+    # With a cache alias, limits are shared between processes through the cache instead: it counts pings in fixed
+    # windows of the time a bucket takes to refill (so up to burst pings per window), which only needs atomic incr.
+    
+    def __init__(self, rate, burst, cache_alias=None):
+        if rate <= 0 or burst < 1:
+            raise ImproperlyConfigured("PING_RATE_LIMIT must be positive and PING_RATE_BURST at least 1")
+        self.config = (rate, burst, cache_alias)
+        self.rate = rate / 60  # tokens per second
+        self.burst = burst
+        self.window = burst / self.rate  # seconds for an empty bucket to refill
+        self.cache = None if cache_alias is None else caches[cache_alias]
+        self.buckets = OrderedDict()  # job ID: (tokens, time last updated), least recently pinged first
+        self.suppressed = OrderedDict()  # job ID: pings rejected since it was last notified, least recently first
+        self.lock = threading.Lock()
+    
+    def allow(self, id, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.cache is None:
+            allowed = self.take_token(id, now)
+        else:
+            allowed = self.count_shared(id)
+        if not allowed:
+            with self.lock:
+                self.suppressed[id] = self.suppressed.pop(id, 0) + 1
+                if len(self.suppressed) > RATE_LIMIT_SIZE:
+                    # Counts for IDs which aren't jobs are never taken, so the one left longest is dropped
+                    self.suppressed.popitem(last=False)
+        return allowed
+    
+    def take_token(self, id, now):
+        with self.lock:
+            # Moved to the end, so the least recently pinged jobs stay at the start
+            tokens, last = self.buckets.pop(id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[id] = (tokens, now)
+            if len(self.buckets) > RATE_LIMIT_SIZE:
+                # Forget the job pinged longest ago (whose bucket is the most likely to have refilled anyway)
+                self.buckets.popitem(last=False)
+        return allowed
+    
+    def count_shared(self, id):
+        key = f'crontrack:pings:{id}:{int(time.time() // self.window)}'
+        self.cache.add(key, 0, timeout=math.ceil(self.window) * 2)
+        try:
+            count = self.cache.incr(key)
+        except ValueError:
+            # Evicted since it was added
+            self.cache.set(key, 1, timeout=math.ceil(self.window) * 2)
+            count = 1
+        return count <= self.burst
+    
+    def take_suppressed(self, id):
+        with self.lock:
+            return self.suppressed.pop(id, 0)
+
+
+# Threads for the async ping view to access the database from (each holding its own connection)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(getattr(settings, 'ASYNC_PING_THREADS', 32), thread_name_prefix='PingWorker')
+        return _executor
+
+
+def worker_task(func, *args):
+    # Django only closes broken connections (or those older than CONN_MAX_AGE) around requests on their own threads,
+    # so it's done around each task on a worker thread too, for stale connections to be replaced rather than fail
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_worker(func, *args):
+    # Run a function which uses the database in the ping thread pool
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), worker_task, func, *args)
+
+
+# Write-behind buffering (see settings.PING_BUFFER): pings are acknowledged straight away, and the latest ping for
+# each job is written in batches by a flusher thread. The job monitor allows for the buffering delay (buffer_delay())
+# before treating a job as failed, and flushes this process's buffer before each pass.
+
+_buffer = None
+_buffer_lock = threading.Lock()
+_known_jobs = set()
+
+
+def buffer_delay():
+    # The longest time a ping can wait in a buffer before being written
+    if getattr(settings, 'PING_BUFFER', None) is None:
+        return timedelta(0)
+    return timedelta(milliseconds=getattr(settings, 'PING_BUFFER_DELAY', 500))
+
+
+def buffer_ping(id, now=None):
+    # Add a ping to this process's buffer, returning False if there's no such job
+    if buffer_known_ping(id, now):
+        return True
+    if not Job.objects.filter(pk=id).exists():
+        return False
+    if len(_known_jobs) >= KNOWN_JOBS_SIZE:
+        _known_jobs.clear()
+    _known_jobs.add(id)
+    return buffer_known_ping(id, now)
+
+
+def buffer_known_ping(id, now=None):
+    # Add a ping to this process's buffer if the job is known to exist, without touching the database.
+    # Returns False if it's not known (it might still exist).
+    if id not in _known_jobs:
+        return False
+    get_buffer().add(id, now or timezone.now())
+    return True
+
+
+def get_buffer():
+    # Get this process's ping buffer, starting one if needed (including in a newly forked worker process)
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None or _buffer.pid != os.getpid():
+            _buffer = PingBuffer(
+                mode=settings.PING_BUFFER,
+                delay=buffer_delay().total_seconds(),
+                spool_dir=getattr(settings, 'PING_SPOOL_DIR', os.path.join(settings.BASE_DIR, 'pingspool')),
+                fsync=getattr(settings, 'PING_BUFFER_FSYNC', False),
+            )
+        return _buffer
+
+
+def flush_pings():
+    # Write any pings buffered in this process
+    if _buffer is not None and _buffer.pid == os.getpid():
+        _buffer.flush()
+
+
+class PingBuffer:
+    # Pings waiting to be written, collapsed to the latest ping time for each job. In 'spool' mode they're also
+    # appended to a file (fsynced after each ping if fsync is set) so they survive the process dying before a flush:
+    # each flush moves on to a new file, and deletes the old one once its pings are written.
+    
+    def __init__(self, mode, delay, spool_dir=None, fsync=False):
+        if mode not in BUFFER_MODES[1:]:
+            raise ImproperlyConfigured(f"PING_BUFFER must be one of {BUFFER_MODES}")
+        if delay <= 0:
+            raise ImproperlyConfigured("PING_BUFFER_DELAY must be a positive number of milliseconds")
+        
+        self.mode = mode
+        self.delay = delay  # seconds between flushes
+        self.pid = os.getpid()
+        self.pings = {}
+        self.lock = threading.Lock()  # held while adding pings
+        self.flush_lock = threading.Lock()  # held while flushing
+        self.running = True
+        self.wakeup = threading.Event()
+        
+        self.spool = None
+        if mode == 'spool':
+            self.spool_dir = spool_dir
+            self.fsync = fsync
+            self.spool_number = 0
+            os.makedirs(spool_dir, exist_ok=True)
+            self.recover()
+            self.open_spool()
+        
+        atexit.register(self.stop)
+        self.t = threading.Thread(target=self.flush_loop, name='PingFlusherThread', daemon=True)
+        self.t.start()
+    
+    def stop(self):
+        # Only the process which started the buffer can stop it (not others forked from it)
+        global _buffer
+        if os.getpid() != self.pid:
+            return
+        with _buffer_lock:
+            if _buffer is self:
+                _buffer = None
+        self.running = False
+        self.wakeup.set()
+        self.flush()
+        if self.spool is not None:
+            self.spool.close()
+            if not self.pings:
+                os.remove(self.spool.name)
+            self.spool = None
+    
+    def add(self, id, now):
+        with self.lock:
+            if id not in self.pings or self.pings[id] < now:
+                self.pings[id] = now
+            if self.spool is not None:
+                self.spool.write(f'{id} {now.isoformat()}\n')
+                self.spool.flush()
+                if self.fsync:
+                    os.fsync(self.spool.fileno())
+    
+    def flush_loop(self):
+        while self.running:
+            self.wakeup.wait(self.delay)
+            if self.running:
+                worker_task(self.flush)
+    
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pings, self.pings = self.pings, {}
+                if self.spool is not None and pings:
+                    old_spool = self.spool
+                    self.open_spool()
+                else:
+                    old_spool = None
+            if not pings:
+                return
+            
+            try:
+                notify_many(pings)
+            except Exception:
+                # Put them back to try again next time
+                logger.exception(f"Failed to write {len(pings)} buffered ping(s)")
+                for id, now in pings.items():
+                    self.add(id, now)
+            if old_spool is not None:
+                old_spool.close()
+                os.remove(old_spool.name)
+    
+    def open_spool(self):
+        self.spool_number += 1
+        path = os.path.join(self.spool_dir, f'pings-{self.pid}-{self.spool_number}.log')
+        self.spool = open(path, 'a')
+    
+    def recover(self):
+        # Write the pings left in spool files by processes which have died (or by this process's PID in the past).
+        # Each file is claimed first by renaming it as one of this process's, so when several processes start together
+        # only the first to rename it recovers it.
+        pings = {}
+        paths = []
+        for path in glob.glob(os.path.join(self.spool_dir, 'pings-*-*.log')):
+            pid = int(os.path.basename(path).split('-')[1])
+            if pid != self.pid and process_exists(pid):
+                continue
+            claimed = os.path.join(self.spool_dir, f'pings-{self.pid}-recovering-{uuid.uuid4().hex}.log')
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Another process claimed it first
+                continue
+            with open(claimed) as f:
+                for line in f:
+                    try:
+                        id, time = line.split()
+                        id = uuid.UUID(id)
+                        now = datetime.fromisoformat(time)
+                    except ValueError:
+                        # Partly written line
+                        continue
+                    if id not in pings or pings[id] < now:
+                        pings[id] = now
+            paths.append(claimed)
+        
+        if pings:
+            logger.info(f"Recovering {len(pings)} buffered ping(s) from {len(paths)} spool file(s)")
+            notify_many(pings)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
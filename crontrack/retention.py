@@ -0,0 +1,100 @@
+# Event retention (rolling up old job events into daily summaries, so the JobEvent table doesn't grow forever)
+import logging
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from . import counters
+from .models import JobEvent, JobEventSummary
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000  # maximum number of events to roll up and delete in a single transaction
+
+
+def retention_cutoff(now=None, days=None):
+    # Get the time before which events are archived, or None if they're kept forever
+    if days is None:
+        days = getattr(settings, 'EVENT_RETENTION_DAYS', None)
+    if days is None:
+        return None
+    if now is None:
+        now = timezone.now()
+    return now - timedelta(days=days)
+
+
+def archive_events(before, batch_size=BATCH_SIZE, limit=None):
+    # Roll up events older than before into each job's JobEventSummary for the day, and delete them.
+    # Works through the oldest events a batch at a time, each in its own short transaction, stopping after limit
+    # events if given. Returns the number of events archived.
+    total = 0
+    while limit is None or total < limit:
+        size = batch_size if limit is None else min(batch_size, limit - total)
+        archived = archive_batch(before, size)
+        total += archived
+        if archived < size:
+            break
+    if total:
+        logger.debug(f"Archived {total} event(s) from before {before}")
+    return total
+
+
+def lock_options():
+    # Options for locking a batch of events, where the database supports them: skipping rows locked by another archiver
+    # (rather than waiting for them), and only locking the events (not the jobs and users joined to them)
+    options = {}
+    if connection.features.has_select_for_update_skip_locked:
+        options['skip_locked'] = True
+    if connection.features.has_select_for_update_of:
+        options['of'] = ('self',)
+    return options
+
+
+def archive_batch(before, size):
+    with transaction.atomic():
+        # Concurrent archivers (where supported) take separate batches, and their summary updates add up
+        events = list(
+            JobEvent.objects
+            .filter(time__lt=before)
+            .order_by('time', 'id')
+            .select_for_update(**lock_options())
+            .values_list('id', 'job', 'type', 'time', 'seen', 'job__user', 'job__team')[:size]
+        )
+        if not events:
+            return 0
+
+        summaries = defaultdict(lambda: {'failures': 0, 'warnings': 0, 'first': None, 'last': None})
+        unseen = Counter()
+        for id, job_id, event_type, time, seen, user_id, team_id in events:
+            summary = summaries[(job_id, time.astimezone(timezone.utc).date())]
+            summary['failures' if event_type == JobEvent.FAILURE else 'warnings'] += 1
+            summary['first'] = time if summary['first'] is None else min(summary['first'], time)
+            summary['last'] = time if summary['last'] is None else max(summary['last'], time)
+            if not seen:
+                unseen[(user_id, team_id)] += 1
+
+        # Make sure each day's summary exists, then add the batch's events to it
+        JobEventSummary.objects.bulk_create(
+            (
+                JobEventSummary(job_id=job_id, date=date, first=summary['first'], last=summary['last'])
+                for (job_id, date), summary in summaries.items()
+            ),
+            ignore_conflicts=True,
+        )
+        for (job_id, date), summary in summaries.items():
+            JobEventSummary.objects.filter(job_id=job_id, date=date).update(
+                failures=F('failures') + summary['failures'],
+                warnings=F('warnings') + summary['warnings'],
+                first=Least('first', summary['first']),
+                last=Greatest('last', summary['last']),
+            )
+        JobEvent.objects.filter(id__in=[event[0] for event in events]).delete()
+
+    counters.adjust(unseen, -1)
+    counters.touch({(user_id, team_id) for id, job_id, event_type, time, seen, user_id, team_id in events})
+    return len(events)
@@ -0,0 +1,182 @@
+# Compiled cron schedules (fast next run time calculation for the cron strings jobs use most)
+import struct
+import zlib
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+
+from croniter import croniter
+
+CACHE_SIZE = 4096  # number of distinct schedule strings to keep compiled
+MAX_DAYS = 366 * 5  # days to search ahead for a matching day before deferring to croniter
+
+utc = dt_timezone.utc
+
+
+class Schedule:
+    # A cron schedule string parsed once into sorted lists and bitsets of the values each field accepts.
+    # Results are identical to croniter's: anything the fast path can't handle exactly (e.g. 'L' or '#' fields,
+    # seconds, or times around a DST change) is passed through to croniter itself.
+
+    def __init__(self, schedule_str):
+        self.schedule_str = schedule_str
+
+        # Parsing with croniter gives us its exact interpretation of the string (and its errors for invalid ones)
+        itr = croniter(schedule_str)
+        expanded = itr.expanded
+        self.seconds = len(expanded) == 6 and expanded[5] != [0]
+        self.fast = (
+            len(expanded) == 5 and
+            not itr.nth_weekday_of_month and
+            not getattr(itr, 'nearest_weekday', None) and
+            all(field == ['*'] or all(isinstance(value, int) for value in field) for field in expanded)
+        )
+        if not self.fast:
+            return
+
+        ranges = (range(60), range(24), range(1, 32), range(1, 13), range(7))
+        minutes, hours, days, months, weekdays = (
+            list(values) if field == ['*'] else sorted(set(field)) for field, values in zip(expanded, ranges)
+        )
+        self.minutes = minutes
+        self.hours = hours
+        self.day_mask = bits(days)
+        self.month_mask = bits(months)
+        self.weekday_mask = bits(weekdays)
+
+        # Like cron, if both the day of month and day of week are restricted, a day matching either one is run on
+        day_wild = expanded[2] == ['*']
+        weekday_wild = expanded[4] == ['*']
+        self.day_or = not day_wild and not weekday_wild
+
+    def __repr__(self):
+        return f'Schedule({self.schedule_str!r})'
+
+    def next_run(self, now):
+        # Equivalent to croniter(self.schedule_str, now).get_next(datetime)
+        if self.fast and now.tzinfo is not None:
+            naive = self.next_naive(now.replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1))
+            if naive is not None:
+                aware = localize(naive, now)
+                if aware is not None:
+                    return aware
+        return croniter(self.schedule_str, now).get_next(datetime)
+
+    def next_naive(self, t):
+        # Find the first naive (wall clock) time at or after t which matches, or None if there's none soon
+        minutes, hours = self.minutes, self.hours
+        for _ in range(MAX_DAYS):
+            if not self.matches_day(t):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+
+            i = bisect_left(hours, t.hour)
+            if i < len(hours):
+                hour = hours[i]
+                minute = t.minute if hour == t.hour else 0
+                j = bisect_left(minutes, minute)
+                if j < len(minutes):
+                    return t.replace(hour=hour, minute=minutes[j])
+                if i + 1 < len(hours):
+                    return t.replace(hour=hours[i + 1], minute=minutes[0])
+            t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+        return None
+
+    def matches_day(self, t):
+        if not self.month_mask >> t.month & 1:
+            return False
+        day = self.day_mask >> t.day & 1
+        weekday = self.weekday_mask >> ((t.weekday() + 1) % 7) & 1  # cron weeks start on Sunday
+        if self.day_or:
+            return bool(day or weekday)
+        return bool(day and weekday)
+
+
+def bits(values):
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
+
+def localize(naive, now):
+    # Attach now's timezone to a naive local time, if that can be done the same way croniter would without any DST
+    # handling (i.e. the time exists, is unambiguous and has the same UTC offset as now). Returns None otherwise.
+    tzinfo = now.tzinfo
+    if hasattr(tzinfo, 'localize'):
+        # pytz timezone
+        try:
+            aware = tzinfo.localize(naive, is_dst=None)
+        except Exception:
+            # Ambiguous or non-existent time
+            return None
+    else:
+        aware = naive.replace(tzinfo=tzinfo)
+        later = naive.replace(tzinfo=tzinfo, fold=1)
+        if aware.utcoffset() != later.utcoffset():
+            return None
+        # A non-existent time won't survive a round trip through UTC
+        if aware.astimezone(utc).astimezone(tzinfo).replace(tzinfo=None) != naive:
+            return None
+    if aware.utcoffset() != now.utcoffset():
+        return None
+    return aware
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_schedule(schedule_str):
+    return Schedule(schedule_str)
+
+
+def next_run(schedule_str, now):
+    # Get the next time a schedule runs after now (an aware datetime in the timezone to use)
+    return compile_schedule(schedule_str).next_run(now)
+
+
+def next_runs(schedules, now):
+    # Batched version of next_run for many jobs at once: takes an iterable of (schedule_str, timezone) pairs and
+    # returns a dict of each distinct pair to its next run time after now, calculating each one only once
+    local_times = {}
+    results = {}
+    for schedule_str, tz in schedules:
+        if (schedule_str, tz) not in results:
+            if tz not in local_times:
+                local_times[tz] = now.astimezone(tz)
+            results[(schedule_str, tz)] = next_run(schedule_str, local_times[tz])
+    return results
+
+
+# Run horizons: a job's next few run times packed into a blob of little-endian 32 bit integers, where the first is a
+# checksum of the schedule string and timezone they were calculated for, and the rest are run times in epoch minutes
+def supports_horizon(schedule_str):
+    # Schedules with a seconds field run part way through a minute, so their run times can't be stored in a horizon
+    return not compile_schedule(schedule_str).seconds
+
+
+def horizon_key(schedule_str, tz):
+    return zlib.crc32(f'{schedule_str}\n{tz}'.encode())
+
+
+def make_horizon(schedule_str, tz, now, size):
+    # Calculate the next size run times after now
+    schedule = compile_schedule(schedule_str)
+    run = now.astimezone(tz)
+    minutes = []
+    for _ in range(size):
+        run = schedule.next_run(run)
+        minutes.append(int(run.timestamp()) // 60)
+    return struct.pack(f'<{size + 1}I', horizon_key(schedule_str, tz), *minutes)
+
+
+def next_from_horizon(horizon, schedule_str, tz, now):
+    # Get the first run time after now from a horizon, or None if it's used up or out of date
+    horizon = bytes(horizon)
+    if len(horizon) < 8:
+        return None
+    key, *minutes = struct.unpack(f'<{len(horizon) // 4}I', horizon)
+    if key != horizon_key(schedule_str, tz):
+        return None
+    i = bisect_right(minutes, now.timestamp() / 60)
+    if i == len(minutes):
+        return None
+    return datetime.fromtimestamp(minutes[i] * 60, utc)
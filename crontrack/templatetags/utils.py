@@ -5,7 +5,7 @@ from pytz import all_timezones
 from django import template
 from django.utils.safestring import mark_safe
 
-from crontrack.models import JobEvent
+from crontrack.counters import unseen_count
 
 register = template.Library()
 
@@ -23,7 +23,7 @@ def timezone_selector(my_timezone):
     return mark_safe(result + '</datalist>')
 
     
-# Count a user's number of unseen events
+# Count a user's number of unseen events (cached, see crontrack.counters)
 @register.simple_tag
 def unseen_event_count(user):
-    return user.all_accessible(JobEvent).filter(seen=False).count()
\ No newline at end of file
+    return unseen_count(user)
\ No newline at end of file
@@ -1,18 +1,50 @@
+import glob
 import logging
+import os
 import random
-from datetime import timedelta
+import re
+import tempfile
+import unittest
+import uuid
+from datetime import datetime, timedelta
 from io import StringIO
+from itertools import chain
+from unittest import mock
+
+import pytz
+from asgiref.sync import async_to_sync
+from croniter import croniter, CroniterBadCronError
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TestCase, SimpleTestCase
+from django.db import DatabaseError, connection
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.http import Http404
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 
+from . import api, counters, pings, views
+from .alerts import AlertDispatcher, get_twilio_client
 from .background import JobMonitor
-from .models import Job, User, Team, TeamMembership
+from .models import (
+    Job, JobEvent, JobEventSummary, JobGroup, MonitorLease, MonitorWorker, PendingAlert, User, Team, TeamMembership,
+)
+from .schedule import compile_schedule, next_run, next_runs
 
 logging.disable(logging.INFO)
 
+# A cache shared between processes, for the counters which aren't kept in local memory caches
+SHARED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), f'crontrack-test-cache-{os.getpid()}'),
+    },
+}
+
 
 class JobTestCase(SimpleTestCase):
     def test_failing(self):
@@ -32,24 +64,1171 @@ class JobTestCase(SimpleTestCase):
             self.assertEqual(job.failing, True)
 
 
+class ScheduleTestCase(SimpleTestCase):
+    SCHEDULES = (
+        '* * * * *', '0 * * * *', '*/15 * * * *', '30 2 * * *', '0 2 * * *', '*/10 1-3 * * *', '45 1,2,3 * * *',
+        '0 0 1 * *', '0 0 * * 0', '0 0 * * 7', '0 0 13 * 5', '59 23 31 12 *', '0 0 29 2 *', '0 12 * * 1-5',
+        '0 9 * jan-mar mon', '5 4 L * *', '0 0 * * 1#2', '* * * * * 30',
+    )
+    TIMEZONES = (
+        'UTC', 'Australia/Sydney', 'America/New_York', 'Europe/London', 'Australia/Lord_Howe', 'Asia/Kolkata',
+    )
+    
+    def assertMatchesCroniter(self, schedule_str, now):
+        expected = croniter(schedule_str, now).get_next(datetime)
+        actual = next_run(schedule_str, now)
+        self.assertEqual(actual, expected, f"'{schedule_str}' from {now}")
+        self.assertEqual(actual.utcoffset(), expected.utcoffset(), f"'{schedule_str}' from {now}")
+    
+    def test_next_run(self):
+        rng = random.Random(0)
+        start = datetime(2019, 1, 1, tzinfo=pytz.utc)
+        for tz in map(pytz.timezone, self.TIMEZONES):
+            for _ in range(50):
+                now = (start + timedelta(seconds=rng.randrange(5 * 365 * 86400))).astimezone(tz)
+                for schedule_str in self.SCHEDULES:
+                    self.assertMatchesCroniter(schedule_str, now)
+    
+    def test_dst(self):
+        # Times on both sides of every DST change (where some local times are skipped or happen twice)
+        for tz in map(pytz.timezone, self.TIMEZONES):
+            for transition in getattr(tz, '_utc_transition_times', ()):
+                if 2019 <= transition.year <= 2021:
+                    for minutes in (-121, -61, -60, -31, -1, 0, 1, 30, 59, 60, 61, 120):
+                        now = pytz.utc.localize(transition + timedelta(minutes=minutes)).astimezone(tz)
+                        for schedule_str in self.SCHEDULES:
+                            self.assertMatchesCroniter(schedule_str, now)
+    
+    def test_next_runs(self):
+        now = timezone.now()
+        sydney = pytz.timezone('Australia/Sydney')
+        pairs = [('0 * * * *', pytz.utc), ('0 * * * *', sydney), ('0 * * * *', pytz.utc)]
+        runs = next_runs(pairs, now)
+        self.assertEqual(len(runs), 2)
+        for schedule_str, tz in pairs:
+            self.assertEqual(runs[(schedule_str, tz)], next_run(schedule_str, now.astimezone(tz)))
+    
+    @override_settings(JOB_RUN_HORIZON=5)
+    def test_horizon(self):
+        sydney = pytz.timezone('Australia/Sydney')
+        job = Job(user=User(timezone=sydney), schedule_str='*/10 * * * *', time_window=5)
+        now = timezone.now()
+        
+        # Runs are taken from the horizon until it's used up
+        self.assertEqual(job.advance(now), True)
+        horizon = job.run_horizon
+        for i in range(5):
+            self.assertEqual(job.next_run, croniter(job.schedule_str, now.astimezone(sydney)).get_next(datetime))
+            self.assertEqual(job.deadline, job.next_run + timedelta(minutes=5))
+            now = job.next_run + timedelta(seconds=30)
+            self.assertEqual(job.advance(now), i == 4)
+        self.assertNotEqual(job.run_horizon, horizon)
+        
+        # Changing the schedule or the owner's timezone recalculates it
+        job.schedule_str = '0 9 * * *'
+        self.assertEqual(job.advance(now), True)
+        self.assertEqual(job.next_run, croniter(job.schedule_str, now.astimezone(sydney)).get_next(datetime))
+        job.user.timezone = pytz.utc
+        self.assertEqual(job.advance(now), True)
+        self.assertEqual(job.next_run, croniter(job.schedule_str, now.astimezone(pytz.utc)).get_next(datetime))
+        
+        # Schedules with seconds aren't stored in whole minutes, so they're always calculated directly
+        job.schedule_str = '* * * * * 30'
+        for i in range(3):
+            self.assertEqual(job.advance(now), False)
+            self.assertEqual(job.next_run, croniter(job.schedule_str, now).get_next(datetime))
+            now = job.next_run
+    
+    def test_invalid(self):
+        self.assertRaises(CroniterBadCronError, next_run, '61 * * * *', timezone.now())
+        self.assertRaises(CroniterBadCronError, compile_schedule, 'not a schedule')
+
+
 class JobMonitorTestCase(TestCase):
     def test_validation(self):
         self.assertRaises(ValueError, JobMonitor, time_limit=0)
         self.assertRaises(ValueError, JobMonitor, time_limit=-5)
     
     def test_stopping(self):
-        monitor = JobMonitor()
-        monitor.stop()
+        # Threaded monitors don't check any jobs here, as the test's transaction keeps the tables locked to them
+        with mock.patch.object(JobMonitor, 'check_jobs'):
+            monitor = JobMonitor()
+            monitor.stop()
+            self.assertEqual(monitor.running, False)
+            monitor.t.join()
+            
+            monitor = JobMonitor(time_limit=JobMonitor.WAIT_INTERVAL, threaded=False)
+            self.assertEqual(monitor.running, False)
+            
+            monitor = JobMonitor(time_limit=JobMonitor.WAIT_INTERVAL+1, threaded=True)
+            self.assertEqual(monitor.running, True)
+            monitor.stop()
+            self.assertEqual(monitor.running, False)
+            monitor.t.join()
+    
+    def test_errors(self):
+        # Errors are logged, and the monitor carries on until it's due to stop
+        with mock.patch.object(JobMonitor, 'check_jobs', side_effect=DatabaseError("database is locked")):
+            with mock.patch('crontrack.background.close_old_connections') as close_old_connections:
+                with self.assertLogs('crontrack.background', logging.ERROR) as logs:
+                    monitor = JobMonitor(time_limit=1, threaded=False)
         self.assertEqual(monitor.running, False)
+        self.assertIn("Error in JobMonitor loop", logs.output[0])
+        self.assertEqual(close_old_connections.call_count, 1)
+    
+    def test_deadline(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        job = Job.objects.create(user=user, name='job', schedule_str='* * * * *', time_window=5, next_run=now)
+        self.assertEqual(job.deadline, now + timedelta(minutes=5))
         
-        monitor = JobMonitor(time_limit=JobMonitor.WAIT_INTERVAL, threaded=False)
-        self.assertEqual(monitor.running, False)
+        job.time_window = 10
+        job.save(update_fields=['time_window'])
+        job.refresh_from_db()
+        self.assertEqual(job.deadline, now + timedelta(minutes=10))
+    
+    def test_check_jobs(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        due = Job.objects.create(
+            user=user, name='due', schedule_str='* * * * *', time_window=1, next_run=now-timedelta(minutes=5),
+        )
+        warning = Job.objects.create(
+            user=user, name='warning', schedule_str='* * * * *', time_window=10, next_run=now-timedelta(minutes=1),
+        )
+        upcoming = Job.objects.create(
+            user=user, name='upcoming', schedule_str='0 0 * * *', time_window=0, next_run=now+timedelta(hours=1),
+        )
+        
+        # Running with a time limit shorter than the wait interval performs a single pass
+        JobMonitor(time_limit=1, threaded=False)
+        
+        due.refresh_from_db()
+        self.assertTrue(due.failed)
+        self.assertGreater(due.next_run, now)
+        self.assertEqual(due.deadline, due.next_run + timedelta(minutes=1))
+        self.assertTrue(JobEvent.objects.filter(job=due, type=JobEvent.FAILURE).exists())
+        
+        self.assertTrue(JobEvent.objects.filter(job=warning, type=JobEvent.WARNING).exists())
+        self.assertFalse(Job.objects.get(pk=warning.pk).failed)
+        
+        self.assertFalse(upcoming.events.exists())
         
-        monitor = JobMonitor(time_limit=JobMonitor.WAIT_INTERVAL+1, threaded=True)
-        self.assertEqual(monitor.running, True)
-        monitor.stop()
+        # Warnings aren't duplicated on the next pass
+        JobMonitor(time_limit=1, threaded=False)
+        self.assertEqual(JobEvent.objects.filter(job=warning, type=JobEvent.WARNING).count(), 1)
+    
+    @override_settings(JOB_RUN_HORIZON=0)
+    def test_batched_next_runs(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        jobs = [
+            Job.objects.create(user=user, name=f'job {i}', schedule_str=schedule_str, next_run=now-timedelta(minutes=5))
+            for i, schedule_str in enumerate(['*/5 * * * *', '*/5 * * * *', '0 * * * *'])
+        ]
+        
+        # Without run horizons, due jobs' next run times are calculated together, once per schedule and timezone
+        with mock.patch('crontrack.background.next_runs', wraps=next_runs) as batched:
+            JobMonitor(time_limit=1, threaded=False)
+        self.assertEqual(batched.call_count, 1)
+        for job, period in zip(jobs, (5, 5, 60)):
+            job.refresh_from_db()
+            self.assertGreater(job.next_run, now)
+            self.assertLessEqual(job.next_run, now + timedelta(minutes=period))
+            self.assertEqual(job.next_run.astimezone(user.timezone).minute % period, 0)
+    
+    def test_event_driven(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        soon = Job.objects.create(
+            user=user, name='soon', schedule_str='* * * * *', time_window=0, next_run=now+timedelta(seconds=30),
+        )
+        Job.objects.create(
+            user=user, name='later', schedule_str='0 * * * *', time_window=5, next_run=now+timedelta(minutes=58),
+        )
+        
+        monitor = JobMonitor(time_limit=1, threaded=False, event_driven=True)
         self.assertEqual(monitor.running, False)
+        self.assertTrue(0 < monitor.load_schedule() <= 30)
+        
+        # Moving the earliest job back means waiting for the next one (capped at the wait interval)
+        monitor.wakeup.clear()
+        soon.next_run = now + timedelta(hours=2)
+        soon.save()
+        monitor.schedule(soon)
+        self.assertEqual(monitor.wakeup.is_set(), False)
+        self.assertEqual(monitor.time_until_next(now), JobMonitor.WAIT_INTERVAL)
+        
+        # Moving a job earlier than anything else wakes the monitor
+        soon.next_run = now + timedelta(seconds=10)
+        soon.save()
+        monitor.schedule(soon)
+        self.assertEqual(monitor.wakeup.is_set(), True)
+        self.assertAlmostEqual(monitor.time_until_next(now), 10, delta=1)
+    
+    def test_sharding(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        for i in range(20):
+            Job.objects.create(
+                user=user, name=f'job {i}', schedule_str='* * * * *', next_run=now-timedelta(minutes=5),
+            )
+        
+        # Shards are released when a worker stops
+        first = JobMonitor(time_limit=1, threaded=False, sharded=True)
+        self.assertEqual(first.shards, [])
+        self.assertFalse(MonitorLease.objects.exclude(owner='').exists())
+        self.assertFalse(MonitorWorker.objects.exists())
+        self.assertEqual(Job.objects.failed().count(), 20)
+        
+        # A lone worker takes every shard, then gives half of them up once another worker joins
+        second = JobMonitor(time_limit=1, threaded=False, sharded=True)
+        first.shards = first.claim_shards()
+        self.assertEqual(len(first.shards), Job.SHARD_COUNT)
+        second.shards = second.claim_shards()
+        self.assertEqual(second.shards, [])
+        first.shards = first.claim_shards()
+        second.shards = second.claim_shards()
+        self.assertEqual(len(first.shards), Job.SHARD_COUNT // 2)
+        self.assertEqual(len(second.shards), Job.SHARD_COUNT // 2)
+        self.assertFalse(set(first.shards) & set(second.shards))
+        
+        # Each job is only visible to the worker holding its shard
+        self.assertEqual(first.get_jobs().count() + second.get_jobs().count(), Job.objects.count())
+        
+        # Shards from a worker whose leases expire are taken over
+        MonitorLease.objects.filter(owner=first.worker_id).update(expires=now-timedelta(seconds=1))
+        MonitorWorker.objects.filter(name=first.worker_id).update(expires=now-timedelta(seconds=1))
+        second.shards = second.claim_shards()
+        self.assertEqual(len(second.shards), Job.SHARD_COUNT)
+    
+    def test_query_count(self):
+        alice = User.objects.create(username='alice', email='alice@example.com', alert_method=User.EMAIL)
+        bob = User.objects.create(username='bob', email='bob@example.com', alert_method=User.EMAIL)
+        team = Team.objects.create(name='team', creator=alice)
+        TeamMembership.objects.create(user=alice, team=team)
+        TeamMembership.objects.create(user=bob, team=team, alerts_on=False)
+        
+        def count_queries(failing):
+            Job.objects.all().delete()
+            for i in range(failing):
+                Job.objects.create(
+                    user=alice, team=(team if i % 2 else None), name=f'job {i}', schedule_str='* * * * *',
+                    next_run=timezone.now()-timedelta(minutes=5),
+                )
+            with CaptureQueriesContext(connection) as context:
+                JobMonitor(time_limit=1, threaded=False)
+            self.assertEqual(PendingAlert.objects.filter(job__in=Job.objects.all()).count(), failing)
+            return len(context.captured_queries)
+        
+        self.assertEqual(count_queries(2), count_queries(20))
+        
+
+class NotifyTestCase(TestCase):
+    def test_notify(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        job = Job.objects.create(
+            user=user, name='job', schedule_str='* * * * *', time_window=10, next_run=now-timedelta(minutes=1),
+        )
+        JobMonitor(time_limit=1, threaded=False)
+        job.refresh_from_db()
+        self.assertTrue(job.has_warning)
+        
+        # Notifying clears the warning
+        response = self.client.get(reverse('crontrack:notify_job', args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+        job.refresh_from_db()
+        self.assertFalse(job.has_warning)
+        self.assertFalse(job.events.exists())
+        self.assertGreaterEqual(job.last_notified, now)
+        self.assertGreater(job.next_run, job.last_notified)
+        self.assertEqual(job.deadline, job.next_run + timedelta(minutes=10))
+        
+        # Without a warning, a notification is a single read and a single write
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('crontrack:notify_job', args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+    
+    def test_unknown_job(self):
+        response = self.client.get(reverse('crontrack:notify_job', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, 404)
+    
+    @override_settings(PING_RATE_LIMIT=1, PING_RATE_BURST=2)
+    def test_rate_limit(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        job = Job.objects.create(user=user, name='job', schedule_str='* * * * *', next_run=timezone.now())
+        url = reverse('crontrack:notify_job', args=[job.id])
         
+        # Pings beyond the burst are rejected without touching the database, and counted
+        for status in (200, 200, 429, 429):
+            with self.assertNumQueries(2 if status == 200 else 0):
+                self.assertEqual(self.client.get(url).status_code, status)
+        pings.notify(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.suppressed_pings, 2)
+        
+        # Buckets refill at the rate limit
+        limiter = pings.get_rate_limiter()
+        self.assertTrue(limiter.allow('other job', now=0))
+        self.assertTrue(limiter.allow('other job', now=0))
+        self.assertFalse(limiter.allow('other job', now=59))
+        self.assertTrue(limiter.allow('other job', now=61))
+        self.assertFalse(limiter.allow('other job', now=62))
+        self.assertEqual(limiter.take_suppressed('other job'), 2)
+        
+        # Only the most recently pinged jobs are tracked
+        with mock.patch('crontrack.pings.RATE_LIMIT_SIZE', 3):
+            for i in range(10):
+                for _ in range(3):
+                    limiter.allow(f'unknown {i}', now=100)
+        self.assertEqual(list(limiter.buckets), ['unknown 7', 'unknown 8', 'unknown 9'])
+        self.assertEqual(list(limiter.suppressed), ['unknown 7', 'unknown 8', 'unknown 9'])
+    
+    def test_bulk(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        now = timezone.now()
+        jobs = [
+            Job.objects.create(user=user, name=f'job {i}', schedule_str='*/5 * * * *', next_run=now)
+            for i in range(20)
+        ]
+        ran_at = now - timedelta(minutes=2)
+        missing = str(uuid.uuid4())
+        entries = [str(job.id) for job in jobs[1:]]
+        entries += [{'id': str(jobs[0].id), 'time': ran_at.isoformat()}, missing, 'nonsense']
+        entries += [{'id': str(jobs[1].id), 'time': 'yesterday'}, str(jobs[2].id).upper()]
+        
+        # The whole batch is handled with a constant number of queries
+        with self.assertNumQueries(4):
+            response = self.client.post(reverse('crontrack:notify_jobs'), entries, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        for job in jobs:
+            self.assertEqual(results[str(job.id)], "ok")
+        self.assertEqual(results[str(jobs[2].id).upper()], "ok")
+        self.assertEqual(results[missing], "not found")
+        self.assertEqual(results['nonsense'], "invalid id")
+        
+        self.assertEqual(Job.objects.filter(last_notified=ran_at).count(), 1)
+        self.assertEqual(Job.objects.filter(last_notified__gt=ran_at).count(), 19)
+        
+        response = self.client.post(reverse('crontrack:notify_jobs'), {'id': missing}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncNotifyTestCase(TransactionTestCase):
+    # Transactional, as the async view writes from another thread (and so another database connection)
+    def test_notify(self):
+        user = User.objects.create(username='alice', email='alice@example.com')
+        job = Job.objects.create(user=user, name='job', schedule_str='* * * * *', next_run=timezone.now())
+        
+        factory = AsyncRequestFactory()
+        with mock.patch('crontrack.pings.close_old_connections') as close_old_connections:
+            response = async_to_sync(views.notify_job_async)(factory.get('/'), job.id)
+        self.assertEqual(response.status_code, 200)
+        job.refresh_from_db()
+        self.assertIsNotNone(job.last_notified)
+        self.assertGreater(job.next_run, job.last_notified)
+        # Stale connections on the worker thread are closed before and after the ping is written
+        self.assertEqual(close_old_connections.call_count, 2)
+        
+        with self.assertRaises(Http404):
+            async_to_sync(views.notify_job_async)(factory.get('/'), uuid.uuid4())
+
+
+# Long enough that the flusher thread never writes during a test (they flush explicitly instead)
+@override_settings(PING_BUFFER='memory', PING_BUFFER_DELAY=60000)
+class PingBufferTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.now = timezone.now()
+        self.jobs = [
+            Job.objects.create(user=self.user, name=f'job {i}', schedule_str='* * * * *', next_run=self.now)
+            for i in range(3)
+        ]
+    
+    def tearDown(self):
+        pings.get_buffer().stop()
+    
+    def test_buffering(self):
+        for job in self.jobs + self.jobs:
+            response = self.client.get(reverse('crontrack:notify_job', args=[job.id]))
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('crontrack:notify_job', args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Job.objects.filter(last_notified__isnull=False).exists())
+        
+        # Repeated pings are collapsed, and written together
+        with self.assertNumQueries(4):
+            pings.flush_pings()
+        for job in self.jobs:
+            job.refresh_from_db()
+            self.assertIsNotNone(job.last_notified)
+            self.assertGreater(job.next_run, job.last_notified)
+    
+    def test_monitor(self):
+        # A job isn't failed until buffered pings have had time to be written
+        job = self.jobs[0]
+        Job.objects.filter(pk=job.pk).update(next_run=self.now - timedelta(seconds=30), deadline=self.now)
+        JobMonitor(time_limit=1, threaded=False)
+        self.assertFalse(Job.objects.get(pk=job.pk).failed)
+        
+        # This process's pings are written before each pass
+        pings.buffer_ping(job.id, self.now - timedelta(seconds=10))
+        Job.objects.filter(pk=job.pk).update(deadline=self.now - timedelta(minutes=2))
+        JobMonitor(time_limit=1, threaded=False)
+        job.refresh_from_db()
+        self.assertFalse(job.failed)
+        self.assertIsNotNone(job.last_notified)
+    
+    @override_settings(PING_BUFFER='spool')
+    def test_spool(self):
+        with tempfile.TemporaryDirectory() as spool_dir, override_settings(PING_SPOOL_DIR=spool_dir):
+            # Pings left behind by a process which died before writing them are recovered
+            dead_pid = 2 ** 22 + 1
+            with open(os.path.join(spool_dir, f'pings-{dead_pid}-1.log'), 'w') as f:
+                f.write(f'{self.jobs[0].id} {self.now.isoformat()}\n{self.jobs[1].id} 2019-')
+            pings.buffer_ping(self.jobs[2].id, self.now)
+            self.assertEqual(Job.objects.filter(last_notified=self.now).count(), 1)
+            
+            pings.flush_pings()
+            self.assertEqual(Job.objects.filter(last_notified=self.now).count(), 2)
+            pings.get_buffer().stop()
+            self.assertEqual(os.listdir(spool_dir), [])
+    
+    def test_spool_recovery_race(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            dead_pid = 2 ** 22 + 1
+            with open(os.path.join(spool_dir, f'pings-{dead_pid}-1.log'), 'w') as f:
+                f.write(f'{self.jobs[0].id} {self.now.isoformat()}\n')
+            
+            # Two buffers starting together both find the dead process's file, but only the first recovers it
+            # (they're stopped in turn, as in one process they'd share their own spool files' names)
+            found = glob.glob(os.path.join(spool_dir, 'pings-*-*.log'))
+            with mock.patch('crontrack.pings.glob.glob', return_value=found):
+                with mock.patch('crontrack.pings.notify_many', wraps=pings.notify_many) as notify_many:
+                    for i in range(2):
+                        pings.PingBuffer('spool', 60, spool_dir).stop()
+            self.assertEqual(notify_many.call_count, 1)
+            self.assertEqual(Job.objects.get(pk=self.jobs[0].pk).last_notified, self.now)
+            self.assertEqual(os.listdir(spool_dir), [])
+
+
+class FakeTwilioClient:
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+        self.messages = self
+    
+    def create(self, body, to, from_):
+        if self.error is not None:
+            raise self.error
+        self.sent.append((to, body))
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    connections = 0
+    
+    def open(self):
+        CountingEmailBackend.connections += 1
+        return super().open()
+
+
+class AlertDispatcherTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice', email='alice@example.com', alert_method=User.EMAIL)
+        self.bob = User.objects.create(
+            username='bob', email='bob@example.com', alert_method=User.SMS, phone='+61400000000',
+        )
+        team = Team.objects.create(name='team', creator=self.alice)
+        TeamMembership.objects.create(user=self.alice, team=team)
+        TeamMembership.objects.create(user=self.bob, team=team)
+        self.job = Job.objects.create(
+            user=self.alice, team=team, name='job', schedule_str='* * * * *',
+            next_run=timezone.now()-timedelta(minutes=5),
+        )
+    
+    def test_validation(self):
+        self.assertRaises(ValueError, AlertDispatcher, time_limit=0)
+        self.assertRaises(ValueError, AlertDispatcher, workers=-1)
+    
+    def test_dispatch(self):
+        # The monitor only queues the alerts
+        JobMonitor(time_limit=1, threaded=False)
+        self.assertEqual(PendingAlert.objects.filter(sent__isnull=True).count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+        
+        client = FakeTwilioClient()
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=client)
+        self.assertEqual(PendingAlert.objects.filter(sent__isnull=True).count(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['alice@example.com'])
+        self.assertEqual(len(client.sent), 1)
+        self.assertEqual(client.sent[0][0], '+61400000000')
+        
+        # Sent alerts aren't sent again, and the same failure can't be queued twice
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=client)
+        self.assertEqual(len(mail.outbox), 1)
+        # (self.job still has the next run time it failed at)
+        duplicate = PendingAlert.for_failure(self.job, self.alice, timezone.now())
+        PendingAlert.objects.bulk_create([duplicate], ignore_conflicts=True)
+        self.assertEqual(PendingAlert.objects.count(), 2)
+    
+    def test_retry(self):
+        now = timezone.now()
+        PendingAlert.objects.create(
+            key='test', job=self.job, user=self.bob, run_time=now, created=now, next_attempt=now,
+        )
+        
+        # Failed alerts are retried later
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=FakeTwilioClient(error=OSError("timed out")))
+        alert = PendingAlert.objects.get()
+        self.assertEqual(alert.sent, None)
+        self.assertEqual(alert.attempts, 1)
+        self.assertEqual(alert.error, "OSError: timed out")
+        self.assertGreater(alert.next_attempt, now + timedelta(seconds=AlertDispatcher.RETRY_DELAY))
+        
+        client = FakeTwilioClient()
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=client)
+        self.assertEqual(client.sent, [])
+        
+        alert.next_attempt = now
+        alert.save()
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=client)
+        alert.refresh_from_db()
+        self.assertNotEqual(alert.sent, None)
+        self.assertEqual(alert.attempts, 2)
+        self.assertEqual(len(client.sent), 1)
+    
+    @override_settings(EMAIL_BACKEND='crontrack.tests.CountingEmailBackend')
+    def test_batching(self):
+        for i in range(10):
+            Job.objects.create(
+                user=self.alice, name=f'job {i}', schedule_str='* * * * *', next_run=timezone.now()-timedelta(minutes=5),
+            )
+        JobMonitor(time_limit=1, threaded=False)
+        
+        # Emails sent by each worker share a connection
+        CountingEmailBackend.connections = 0
+        AlertDispatcher(time_limit=1, threaded=False, workers=2, twilio_client=FakeTwilioClient())
+        self.assertEqual(len(mail.outbox), 11)
+        self.assertEqual(CountingEmailBackend.connections, 2)
+        self.assertFalse(PendingAlert.objects.filter(sent__isnull=True).exists())
+    
+    def test_digest(self):
+        self.alice.alert_digest = True
+        self.alice.digest_window = 10
+        self.alice.save()
+        for i in range(5):
+            Job.objects.create(
+                user=self.alice, name=f'job {i}', schedule_str='* * * * *', next_run=timezone.now()-timedelta(minutes=5),
+            )
+        JobMonitor(time_limit=1, threaded=False)
+        
+        # Alerts are held until the digest window has passed
+        client = FakeTwilioClient()
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=client)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(client.sent), 1)
+        
+        # Then sent together in one message, including any alerts queued since
+        PendingAlert.objects.filter(user=self.alice, job__name='job 0').update(next_attempt=timezone.now())
+        AlertDispatcher(time_limit=1, threaded=False, twilio_client=client)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("6 jobs failed", mail.outbox[0].subject)
+        for i in range(5):
+            self.assertIn(f'job {i}', mail.outbox[0].body)
+        self.assertFalse(PendingAlert.objects.filter(sent__isnull=True).exists())
+    
+    def test_errors(self):
+        JobMonitor(time_limit=1, threaded=False)
+        send_pending = AlertDispatcher.send_pending
+        calls = []
+        
+        def flaky_send_pending(dispatcher):
+            calls.append(dispatcher)
+            if len(calls) == 1:
+                raise DatabaseError("lost connection")
+            return send_pending(dispatcher)
+        
+        # The failed pass is logged, and the alerts are sent on the next one
+        with mock.patch.object(AlertDispatcher, 'send_pending', flaky_send_pending):
+            with mock.patch.object(AlertDispatcher, 'WAIT_INTERVAL', 0.1):
+                with mock.patch('crontrack.alerts.close_old_connections') as close_old_connections:
+                    with self.assertLogs('crontrack.alerts', logging.ERROR) as logs:
+                        AlertDispatcher(time_limit=1, threaded=False, twilio_client=FakeTwilioClient())
+        self.assertIn("Error sending alerts", logs.output[0])
+        self.assertEqual(close_old_connections.call_count, 1)
+        self.assertGreater(len(calls), 1)
+        self.assertFalse(PendingAlert.objects.filter(sent__isnull=True).exists())
+        self.assertEqual(len(mail.outbox), 1)
+    
+    def test_delete_old(self):
+        now = timezone.now()
+        old = now - timedelta(days=31)
+        alerts = [
+            ('sent', old, old, 1), ('recent', now, now, 1), ('failed', None, old, AlertDispatcher.MAX_ATTEMPTS),
+            ('retrying', None, old, 1),
+        ]
+        PendingAlert.objects.bulk_create(
+            PendingAlert(
+                key=key, job=self.job, user=self.bob, run_time=old, created=old, next_attempt=next_attempt,
+                sent=sent, attempts=attempts,
+            )
+            for key, sent, next_attempt, attempts in alerts
+        )
+        
+        # Old sent and given up alerts are deleted, once per interval
+        dispatcher = AlertDispatcher(time_limit=1, threaded=False, twilio_client=FakeTwilioClient())
+        self.assertEqual(set(PendingAlert.objects.values_list('key', flat=True)), {'recent', 'retrying'})
+        PendingAlert.objects.filter(key='recent').update(sent=old)
+        self.assertEqual(dispatcher.delete_old(), 0)
+        dispatcher.last_cleaned -= timedelta(seconds=AlertDispatcher.CLEANUP_INTERVAL)
+        self.assertEqual(dispatcher.delete_old(), 1)
+        
+        with override_settings(ALERT_RETENTION_DAYS=None):
+            PendingAlert.objects.update(sent=old)
+            self.assertEqual(AlertDispatcher(time_limit=1, threaded=False).delete_old(), 0)
+    
+    def test_twilio_client(self):
+        self.assertIs(get_twilio_client(), get_twilio_client())
+
+
+@override_settings(CACHES=SHARED_CACHES, UNSEEN_COUNT_CACHE='shared')
+class DashboardTestCase(TestCase):
+    def setUp(self):
+        counters.get_cache().clear()
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.client.force_login(self.user)
+        now = timezone.now()
+        job = Job.objects.create(user=self.user, name='job', schedule_str='* * * * *', next_run=now)
+        other_job = Job.objects.create(
+            user=User.objects.create(username='bob', email='bob@example.com'),
+            name='job', schedule_str='* * * * *', next_run=now,
+        )
+        # Some events share a time, so pages have to be split by ID too
+        JobEvent.objects.bulk_create(JobEvent(job=job, time=now - timedelta(minutes=i // 3)) for i in range(45))
+        JobEvent.objects.bulk_create(JobEvent(job=other_job, time=now) for i in range(5))
+    
+    def test_pages(self):
+        response = self.client.get(reverse('crontrack:dashboard', args=[10]))
+        self.assertEqual(len(response.context['events']), 10)
+        seen = [event.id for event in response.context['events']]
+        
+        # Later pages cost the same number of queries however far back they are (the session, user, user's team
+        # memberships and the page)
+        next_page = response.context['next_page']
+        while next_page is not None:
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse('crontrack:dashboard_events'), {'per_page': 10, **next_page})
+            data = response.json()
+            seen += [int(id) for id in re.findall(r'<div id="(\d+)"', data['html'])]
+            next_page = data['next_page']
+        
+        expected = JobEvent.objects.filter(job__user=self.user).order_by('-time', '-id')
+        self.assertEqual(seen, list(expected.values_list('id', flat=True)))
+    
+    def test_mark_seen(self):
+        mine = list(JobEvent.objects.filter(job__user=self.user).order_by('-time', '-id'))
+        others = list(JobEvent.objects.exclude(job__user=self.user).values_list('id', flat=True))
+        
+        # A page is marked seen with a single update, which ignores events the user can't access
+        ids = ','.join(str(id) for id in [event.id for event in mine[:20]] + others)
+        with self.assertNumQueries(5):
+            self.client.post(reverse('crontrack:dashboard'), {'ids': ids}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(JobEvent.objects.filter(seen=True).count(), 20)
+        
+        # As is everything up to a given time
+        until = mine[30].time
+        with self.assertNumQueries(5):
+            self.client.post(
+                reverse('crontrack:dashboard'), {'until': until.isoformat()}, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            )
+        self.assertEqual(
+            set(JobEvent.objects.filter(seen=False).values_list('id', flat=True)),
+            {event.id for event in mine[20:] if event.time > until} | set(others),
+        )
+    
+    def test_invalid_page(self):
+        for params in ({}, {'time': 'yesterday', 'id': 1}, {'time': timezone.now().isoformat(), 'id': 'x'}):
+            response = self.client.get(reverse('crontrack:dashboard_events'), params)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('crontrack:dashboard', args=[100000])).status_code, 404)
+
+
+class ViewJobsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        self.client.force_login(self.user)
+        self.add_jobs(0)
+    
+    def add_jobs(self, n):
+        # Add a team with grouped and ungrouped jobs from both users, and the same for jobs without a team and in a
+        # team the user isn't in (which shouldn't be shown)
+        now = timezone.now()
+        team = Team.objects.create(name=f'team {n}', creator=self.other)
+        TeamMembership.objects.create(user=self.user, team=team)
+        other_team = Team.objects.create(name=f'other team {n}', creator=self.other)
+        for user in (self.user, self.other):
+            for job_team in (None, team, other_team):
+                group = JobGroup.objects.create(name=f'group {n}', user=user, team=job_team)
+                for job_group in (group, None):
+                    Job.objects.create(
+                        user=user, team=job_team, group=job_group, name=f'job {n}', schedule_str='* * * * *',
+                        next_run=now,
+                    )
+        JobGroup.objects.create(name=f'empty group {n}', user=self.user, team=team)
+    
+    def get_groups(self, filters={}, per_page=views.JOB_GROUPS_PER_PAGE):
+        # Load every page of groups shown with the given filters, as (group ID, team ID, job IDs) for each
+        filters = views.get_job_filters(filters)
+        job_groups, after = views.get_job_page(self.user, filters, per_page=per_page)
+        while after is not None:
+            page, after = views.get_job_page(self.user, filters, after, per_page)
+            job_groups += page
+        return [
+            (group['id'], group['team'] and group['team'].id, sorted(job.id for job in group['jobs']))
+            for group in job_groups
+        ]
+    
+    def test_pages(self):
+        for n in range(1, 4):
+            self.add_jobs(n)
+        
+        # Same groups and jobs as getting each group separately, with the ungrouped jobs first
+        expected = []
+        for team in chain((None,), self.user.teams.order_by('id')):
+            job_group = views.get_job_group(self.user, None, team)
+            if job_group is not None:
+                expected.append(job_group)
+        for group in self.user.all_accessible(JobGroup).order_by('id'):
+            job_group = views.get_job_group(self.user, group, group.team)
+            if job_group is not None and (group.team is None or group.team_id in self.user.memberships()):
+                expected.append(job_group)
+        expected = [
+            (group['id'], group['team'] and group['team'].id, sorted(job.id for job in group['jobs']))
+            for group in expected
+        ]
+        self.assertEqual(self.get_groups(), expected)
+        self.assertEqual(self.get_groups(per_page=3), expected)
+        self.assertEqual(self.get_groups(per_page=1), expected)
+    
+    def test_filters(self):
+        self.add_jobs(1)
+        team = self.user.teams.get(name='team 1')
+        group = JobGroup.objects.get(name='group 1', user=self.user, team=team)
+        Job.objects.filter(group=group).update(schedule_str='0 * * * *')
+        
+        groups = self.get_groups({'team': team.id})
+        self.assertEqual({group_team for group_id, group_team, jobs in groups}, {team.id})
+        self.assertEqual(len(groups), 4)  # ungrouped, both users' groups and the empty group
+        groups = self.get_groups({'team': 'None'})
+        self.assertEqual({group_team for group_id, group_team, jobs in groups}, {None})
+        self.assertEqual(self.get_groups({'team': team.id, 'group': 'None'}), self.get_groups({'team': team.id})[:1])
+        self.assertEqual(
+            self.get_groups({'group': group.id}),
+            [(group.id, team.id, sorted(Job.objects.filter(group=group).values_list('id', flat=True)))],
+        )
+        
+        # Job filters skip groups without any matching jobs
+        groups = self.get_groups({'schedule': '0  *  * * *'})
+        self.assertEqual([group_id for group_id, team_id, jobs in groups], [group.id])
+        groups = self.get_groups({'name': 'job 1'})
+        self.assertEqual(sum(len(jobs) for group_id, team_id, jobs in groups), 6)
+        empty = JobGroup.objects.get(name='empty group 1')
+        self.assertNotIn(empty.id, [group_id for group_id, team_id, jobs in groups])
+        self.assertEqual(self.get_groups({'name': 'nothing'}), [])
+        
+        # Teams the user isn't in show nothing, and invalid filters aren't found
+        self.assertEqual(self.get_groups({'team': Team.objects.get(name='other team 1').id}), [])
+        self.assertEqual(self.client.get(reverse('crontrack:view_jobs'), {'team': 'x'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('crontrack:view_jobs'), {'status': 'x'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('crontrack:view_jobs_page'), {'after': 'x'}).status_code, 400)
+    
+    def test_queries(self):
+        # Prime the cached unseen event count shown in the navbar
+        self.client.get(reverse('crontrack:view_jobs'))
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('crontrack:view_jobs'))
+        
+        for n in range(1, 20):
+            self.add_jobs(n)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(reverse('crontrack:view_jobs'))
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(len(response.context['team_tabs']), 22)
+        self.assertEqual(sum(count for label, count, url, selected in response.context['status_filters'][1:]), 20 * 6)
+        
+        # Only the first page of groups is loaded, and the rest follow on from it at the same cost
+        job_groups = response.context['job_groups']
+        self.assertEqual(len(job_groups), 21 + views.JOB_GROUPS_PER_PAGE)
+        self.assertEqual(response.context['next_page'], job_groups[-1]['id'])
+        with CaptureQueriesContext(connection) as more:
+            response = self.client.get(reverse('crontrack:view_jobs_page'), {'after': job_groups[-1]['id']})
+        data = response.json()
+        self.assertIn('rowGroupHeader', data['html'])
+        self.assertLess(len(more), len(large))
+
+
+class JobStatusTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.client.force_login(self.user)
+        now = timezone.now()
+        hour = timedelta(hours=1)
+        jobs = {
+            'failed': {'next_run': now + hour, 'last_failed': now - hour},
+            'failing': {'next_run': now - hour},
+            'failing again': {'next_run': now - hour, 'last_notified': now - 2 * hour},
+            'ok': {'next_run': now + hour},
+            'notified': {'next_run': now - hour, 'last_notified': now - hour / 2},
+        }
+        for name, fields in jobs.items():
+            Job.objects.create(user=self.user, name=name, schedule_str='* * * * *', time_window=120, **fields)
+    
+    def test_status(self):
+        now = timezone.now()
+        expected = {
+            job.name: Job.FAILED if job.failed else Job.FAILING if job.failing else Job.OK
+            for job in Job.objects.all()
+        }
+        self.assertEqual({job.name: job.status for job in Job.objects.with_status(now)}, expected)
+        for status, label in Job.STATUS_CHOICES:
+            self.assertEqual(
+                {job.name for job in Job.objects.filter_status(status, now)},
+                {name for name in expected if expected[name] == status},
+            )
+        self.assertRaises(ValueError, Job.objects.filter_status, 'broken')
+    
+    def test_view(self):
+        response = self.client.get(reverse('crontrack:view_jobs'), {'status': Job.FAILING, 'sort': 'status'})
+        jobs = [job for group in response.context['job_groups'] for job in group['jobs']]
+        self.assertEqual({job.name for job in jobs}, {'failing', 'failing again'})
+        self.assertEqual(
+            [(label, count, selected) for label, count, url, selected in response.context['status_filters']],
+            [('all', 5, False), ('ok', 2, False), ('failing', 2, True), ('failed', 1, False)],
+        )
+        
+        # Sorted with the most severe first
+        response = self.client.get(reverse('crontrack:view_jobs'), {'sort': 'status'})
+        jobs = [job for group in response.context['job_groups'] for job in group['jobs']]
+        self.assertEqual([job.status for job in jobs], ['failed', 'failing', 'failing', 'ok', 'ok'])
+
+
+@override_settings(CACHES=SHARED_CACHES, UNSEEN_COUNT_CACHE='shared')
+class UnseenCountTestCase(TestCase):
+    def setUp(self):
+        counters.get_cache().clear()
+        self.alice = User.objects.create(username='alice', email='alice@example.com')
+        self.bob = User.objects.create(username='bob', email='bob@example.com')
+        self.team = Team.objects.create(name='team', creator=self.alice)
+        TeamMembership.objects.create(user=self.alice, team=self.team)
+        now = timezone.now()
+        self.job = Job.objects.create(
+            user=self.alice, team=self.team, name='job', schedule_str='* * * * *', time_window=10,
+            next_run=now - timedelta(minutes=1),
+        )
+        Job.objects.create(user=self.bob, name='job', schedule_str='* * * * *', next_run=now - timedelta(minutes=1))
+    
+    def assertCounts(self, alice, bob):
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.unseen_count(self.alice), alice)
+            self.assertEqual(counters.unseen_count(self.bob), bob)
+        for user in (self.alice, self.bob):
+            self.assertEqual(counters.unseen_count(user), counters.count_unseen(user))
+    
+    def test_counts(self):
+        counters.unseen_count(self.alice)
+        counters.unseen_count(self.bob)
+        
+        # The monitor adds its warnings and failures to the cached counts
+        JobMonitor(time_limit=1, threaded=False)
+        self.assertCounts(1, 1)
+        
+        # Joining a team invalidates the new member's count
+        with self.captureOnCommitCallbacks(execute=True):
+            TeamMembership.objects.create(user=self.bob, team=self.team)
+        self.assertEqual(counters.unseen_count(self.bob), 2)
+        
+        # Notifying a job deletes its warning
+        self.client.get(reverse('crontrack:notify_job', args=[self.job.id]))
+        self.assertCounts(0, 1)
+        
+        self.client.force_login(self.bob)
+        until = timezone.now().isoformat()
+        self.client.post(reverse('crontrack:dashboard'), {'until': until}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertCounts(0, 0)
+        
+        # Deleting a team shows its jobs' events to their owners only
+        JobEvent.objects.create(job=self.job, time=timezone.now())
+        counters.adjust({(self.alice.id, self.team.id): 1})
+        self.assertCounts(1, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.team.delete()
+        self.assertEqual(counters.unseen_count(self.alice), 1)
+        self.assertEqual(counters.unseen_count(self.bob), 0)
+    
+    def test_recount(self):
+        JobEvent.objects.bulk_create(JobEvent(job=job, time=timezone.now()) for job in Job.objects.all())
+        TeamMembership.objects.create(user=self.bob, team=self.team)
+        counters.get_cache().set(counters.cache_key(self.alice.id), 100)
+        
+        call_command('recountevents', stdout=StringIO())
+        self.assertCounts(1, 2)
+    
+    @override_settings(UNSEEN_COUNT_CACHE='default')
+    def test_local_cache(self):
+        # Other processes can't adjust counts in a local memory cache, so they're counted on each use instead
+        self.assertIsNone(counters.get_cache())
+        self.assertEqual(counters.unseen_count(self.alice), 0)
+        JobMonitor(time_limit=1, threaded=False)
+        self.assertEqual(counters.unseen_count(self.alice), 1)
+        call_command('recountevents', stdout=StringIO())
+        self.assertEqual(counters.unseen_count(self.bob), 1)
+
+
+@override_settings(CACHES=SHARED_CACHES, UNSEEN_COUNT_CACHE='shared')
+class RetentionTestCase(TestCase):
+    def setUp(self):
+        counters.get_cache().clear()
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.job = Job.objects.create(user=self.user, name='job', schedule_str='* * * * *', next_run=timezone.now())
+        self.now = timezone.now()
+        day = datetime(2020, 1, 1, tzinfo=pytz.utc)
+        self.old = JobEvent.objects.bulk_create(
+            JobEvent(job=self.job, type=event_type, time=day + timedelta(hours=i * 8), seen=i % 2 == 0)
+            for i, event_type in enumerate('FWFFW')
+        )
+        JobEvent.objects.bulk_create(JobEvent(job=self.job, time=self.now) for i in range(3))
+    
+    def test_archive(self):
+        self.assertEqual(counters.unseen_count(self.user), 5)
+        call_command('archiveevents', days=90, **{'batch-size': 2}, stdout=StringIO())
+        
+        self.assertEqual(list(JobEvent.objects.values_list('time', flat=True)), [self.now] * 3)
+        summaries = self.job.event_summaries.order_by('date')
+        self.assertEqual(
+            [(s.date.isoformat(), s.failures, s.warnings, s.first, s.last) for s in summaries],
+            [
+                ('2020-01-01', 2, 1, self.old[0].time, self.old[2].time),
+                ('2020-01-02', 1, 1, self.old[3].time, self.old[4].time),
+            ],
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.unseen_count(self.user), 3)
+        
+        # Later events for the same day are added to its summary
+        JobEvent.objects.create(job=self.job, time=self.old[4].time + timedelta(hours=1))
+        call_command('archiveevents', days=90, stdout=StringIO())
+        summary = summaries.last()
+        self.assertEqual((summary.failures, summary.last), (2, self.old[4].time + timedelta(hours=1)))
+    
+    def test_monitor(self):
+        # Off by default
+        JobMonitor(time_limit=1, threaded=False)
+        self.assertFalse(JobEventSummary.objects.exists())
+        
+        with override_settings(EVENT_ARCHIVE_INTERVAL=24):
+            monitor = JobMonitor(time_limit=1, threaded=False)
+        self.assertEqual(JobEventSummary.objects.count(), 2)
+        self.assertIsNotNone(monitor.last_archived)
+        
+        # Errors are logged without stopping the monitor
+        with override_settings(EVENT_ARCHIVE_INTERVAL=24), self.assertLogs('crontrack.background', logging.ERROR):
+            with mock.patch('crontrack.retention.archive_events', side_effect=DatabaseError):
+                monitor = JobMonitor(time_limit=1, threaded=False)
+        self.assertIsNotNone(monitor.last_archived)
+    
+    def test_invalid(self):
+        with override_settings(EVENT_RETENTION_DAYS=None):
+            self.assertRaises(CommandError, call_command, 'archiveevents', stdout=StringIO())
+        self.assertRaises(CommandError, call_command, 'archiveevents', days=-1, stdout=StringIO())
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', "query plans are checked with SQLite")
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.job = Job.objects.create(user=self.user, name='job', schedule_str='* * * * *', next_run=timezone.now())
+    
+    def assertIndexed(self, queryset, *indexes):
+        # Fails if the query reads a whole table rather than searching an index
+        plan = queryset.explain()
+        for line in plan.splitlines():
+            self.assertNotRegex(line, r'\bSCAN (TABLE )?\w+$', f"full table scan in query plan:\n{plan}")
+        for index in indexes:
+            self.assertIn(index, plan)
+    
+    def test_events(self):
+        now = timezone.now()
+        self.assertIndexed(JobEvent.objects.filter(job=self.job, type=JobEvent.WARNING), 'jobevent_job_type_idx')
+        self.assertIndexed(JobEvent.objects.filter(job__in=[self.job], type=JobEvent.WARNING), 'jobevent_job_type_idx')
+        self.assertIndexed(
+            self.user.all_accessible(JobEvent).filter(seen=False).order_by(), 'jobevent_job_seen_time_idx',
+        )
+        self.assertIndexed(
+            self.user.all_accessible(JobEvent).filter(time__lt=now).order_by('-time', '-id')[:20],
+            'jobevent_job_seen_time_idx',
+        )
+        self.assertIndexed(JobEvent.objects.filter(time__lt=now).order_by('time', 'id'), 'jobevent_time_idx')
+    
+    def test_jobs(self):
+        now = timezone.now()
+        self.assertIndexed(Job.objects.running(), 'job_failed_next_run_idx (last_failed=?)')
+        self.assertIndexed(Job.objects.failed(), 'job_failed_next_run_idx (last_failed>?)')
+        self.assertIndexed(Job.objects.filter_status(Job.FAILING, now), 'job_failed_next_run_idx (last_failed=? AND')
+        self.assertIndexed(Job.objects.filter_status(Job.FAILED, now), 'job_failed_next_run_idx (last_failed>?)')
+        self.assertIndexed(
+            Job.objects.filter(deadline__gt=now, next_run__lt=now, last_failed__isnull=True, has_warning=False),
+            'job_failed_next_run_idx (last_failed=? AND next_run<?)',
+        )
+        self.assertIndexed(Job.objects.filter(shard__in=[0, 1], deadline__lte=now))
+        self.assertIndexed(Job.objects.filter(group__isnull=True, team__in=[1, 2]), 'job_team_group_idx')
+        self.assertIndexed(Job.objects.filter(team=1), 'job_team_group_idx')
+
+
+class MembershipTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        self.teams = [Team.objects.create(name=f'team {i}', creator=self.other) for i in range(3)]
+        TeamMembership.objects.create(user=self.user, team=self.teams[0])
+        TeamMembership.objects.create(user=self.user, team=self.teams[1], alerts_on=False)
+        now = timezone.now()
+        for team in chain((None,), self.teams):
+            for user in (self.user, self.other):
+                Job.objects.create(user=user, team=team, name='job', schedule_str='* * * * *', next_run=now)
+    
+    def test_access(self):
+        self.assertEqual(self.user.memberships(), {self.teams[0].id: True, self.teams[1].id: False})
+        
+        # Access checks are set lookups after the memberships are loaded once
+        user = User.objects.get(pk=self.user.pk)
+        jobs = list(Job.objects.all())
+        with self.assertNumQueries(1):
+            access = {job.id for job in jobs if user.can_access(job)}
+        self.assertEqual(access, set(user.all_accessible(Job).values_list('id', flat=True)))
+        self.assertEqual(len(access), 6)
+        
+        # Membership changes are picked up straight away
+        membership = TeamMembership.objects.create(user=self.user, team=self.teams[2])
+        self.assertIn(self.teams[2].id, user.memberships())
+        membership.delete()
+        self.assertNotIn(self.teams[2].id, user.memberships())
+    
+    @override_settings(MEMBERSHIP_CACHE_TIMEOUT=60)
+    def test_cache(self):
+        # Other requests (with their own User instances) share the memberships through the cache
+        self.user.memberships()
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(user.memberships()), 2)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            TeamMembership.objects.filter(user=self.user, team=self.teams[0]).get().delete()
+        self.assertEqual(User.objects.get(pk=self.user.pk).memberships(), {self.teams[1].id: False})
+
+
+@override_settings(CACHES=SHARED_CACHES, CHANGE_COUNTER_CACHE='shared')
+class ApiTestCase(TestCase):
+    def setUp(self):
+        counters.get_changes_cache().clear()
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        self.team = Team.objects.create(name='team', creator=self.other)
+        TeamMembership.objects.create(user=self.user, team=self.team)
+        now = timezone.now()
+        self.jobs = [
+            Job.objects.create(user=user, team=team, name=f'job {i}', schedule_str='* * * * *', next_run=now)
+            for i, (user, team) in enumerate([(self.user, None), (self.other, self.team), (self.other, None)])
+        ]
+        for i in range(5):
+            JobEvent.objects.create(job=self.jobs[i % 2], time=now - timedelta(minutes=i))
+        self.client.force_login(self.user)
+    
+    def get_all(self, url, params):
+        # Follow the next links through every page of results
+        results = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            results += response.json()['results']
+            if response.json()['next'] is None:
+                return results
+            response = self.client.get(response.json()['next'])
+    
+    def test_jobs(self):
+        url = reverse('crontrack:api_jobs')
+        jobs = self.client.get(url).json()['results']
+        self.assertEqual({job['id'] for job in jobs}, {str(job.id) for job in self.jobs[:2]})
+        self.assertEqual(set(jobs[0]), set(api.JOB_FIELDS))
+        self.assertEqual(self.get_all(url, {'limit': 1, 'fields': 'id'}), [{'id': job['id']} for job in jobs])
+        self.assertEqual(
+            self.get_all(url, {'team': self.team.id, 'fields': 'name,team,status'}),
+            [{'name': 'job 1', 'team': self.team.id, 'status': Job.FAILING}],
+        )
+        
+        for params in ({'fields': 'name,password'}, {'limit': 0}, {'after': 'x'}, {'status': 'x'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        self.assertEqual(self.client.post(url).status_code, 405)
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 401)
+    
+    def test_events(self):
+        url = reverse('crontrack:api_events')
+        events = self.get_all(url, {'limit': 2})
+        self.assertEqual([event['id'] for event in events], list(JobEvent.objects.order_by('-time').values_list(
+            'id', flat=True,
+        )))
+        self.assertEqual(events[0], {
+            'id': events[0]['id'], 'job': str(self.jobs[0].id), 'type': 'failure', 'time': events[0]['time'],
+            'seen': False,
+        })
+        self.assertEqual(self.client.get(url, {'after': 'x,1'}).status_code, 400)
+    
+    def test_etag(self):
+        url = reverse('crontrack:api_jobs')
+        response = self.client.get(url)
+        etag = response['ETag']
+        
+        # Unchanged polls are answered without loading any jobs
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(any('crontrack_job' in query['sql'] for query in queries))
+        self.assertNotEqual(self.client.get(url, {'limit': 1})['ETag'], etag)
+        
+        # Pings, edits, seen events and changes in teams all change it
+        changes = [
+            lambda: pings.notify(self.jobs[0].id),
+            lambda: Job.objects.filter(pk=self.jobs[1].pk).get().save(),
+            lambda: counters.mark_seen(JobEvent.objects.filter(job=self.jobs[1])),
+            lambda: TeamMembership.objects.filter(user=self.user).delete(),
+        ]
+        for change in changes:
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+        
+        # Changes the user can't see don't
+        with self.captureOnCommitCallbacks(execute=True):
+            pings.notify(self.jobs[2].id)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+    
+    @override_settings(CHANGE_COUNTER_CACHE='default')
+    def test_etag_local_cache(self):
+        # Other processes can't bump counters in a local memory cache, so there's no ETag to go stale
+        self.assertIsNone(counters.get_changes_cache())
+        with self.captureOnCommitCallbacks(execute=True):
+            pings.notify(self.jobs[0].id)
+        response = self.client.get(reverse('crontrack:api_jobs'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
 
 class UserTestCase(TestCase):
     def setup(self):
@@ -1,14 +1,17 @@
+from django.conf import settings
 from django.urls import path, include, reverse_lazy
 from django.contrib.auth import views as auth_views
 
-from . import views
+from . import api, views
 
 app_name = 'crontrack'
 urlpatterns = [
     path('', views.index, name='index'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('dashboard/<int:per_page>/', views.dashboard, name='dashboard'),
+    path('dashboard/events/', views.dashboard_events, name='dashboard_events'),
     path('viewjobs/', views.view_jobs, name='view_jobs'),
+    path('viewjobs/groups/', views.view_jobs_page, name='view_jobs_page'),
     path('addjob/', views.add_job, name='add_job'),
     path('editjob/', views.edit_job, name='edit_job'),
     path('editgroup/', views.edit_group, name='edit_group'),
@@ -16,7 +19,11 @@ urlpatterns = [
     path('deletejob/', views.delete_job, name='delete_job'),
     path('teams/', views.teams, name='teams'),
     
-    path('p/<uuid:id>/', views.notify_job, name='notify_job'),
+    path('api/v1/jobs/', api.jobs, name='api_jobs'),
+    path('api/v1/events/', api.events, name='api_events'),
+    
+    path('p/', views.notify_jobs, name='notify_jobs'),
+    path('p/<uuid:id>/', views.notify_job_async if settings.ASYNC_PINGS else views.notify_job, name='notify_job'),
     
     path('accounts/profile/', views.profile, name='profile'),
     path('accounts/register/', views.RegisterView.as_view(), name='register'),
@@ -1,102 +1,267 @@
+import json
 import logging
-import math
 import re
+import uuid
+from collections import defaultdict
 from datetime import datetime
-from itertools import chain
 
 import pytz
-from croniter import croniter, CroniterBadCronError  # see https://pypi.org/project/croniter/#usage
+from croniter import CroniterBadCronError  # see https://pypi.org/project/croniter/#usage
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.http import HttpResponseRedirect, JsonResponse
+from django.db.models import Count, Exists, OuterRef, Q
+from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
+from . import counters, pings
+from .background import reschedule_job
 from .forms import ProfileForm, RegisterForm
 from .models import Job, JobGroup, JobAlert, JobEvent, User, Team, TeamMembership
+from .schedule import next_run
 
 logger = logging.getLogger(__name__)
 
+DASHBOARD_PAGE_SIZES = (10, 20, 50, 100)  # choices for the number of events per page on the dashboard
+JOB_GROUPS_PER_PAGE = 20  # number of job groups loaded at a time on the view jobs page
+
 
 def index(request):
     return render(request, 'crontrack/index.html')
 
 
+def rate_limited():
+    return JsonResponse({'error_message': "Too many notifications for this job, please try again later."}, status=429)
+
+
 def notify_job(request, id):
-    # Update job's last_notified, last_failed, and next_run
-    job = Job.objects.get(pk=id)
-    job.last_notified = timezone.now()
-    job.last_failed = None
-    now = timezone.localtime(timezone.now(), job.user.timezone)
-    job.next_run = croniter(job.schedule_str, now).get_next(datetime)
-    job.save()
-    
-    # Delete the JobEvent warning(s)
-    JobEvent.objects.filter(job=job, type=JobEvent.WARNING).delete()
+    if not pings.allow_ping(id):
+        return rate_limited()
+    if getattr(settings, 'PING_BUFFER', None) is None:
+        found = pings.notify(id) is not None
+    else:
+        found = pings.buffer_ping(id)
+    if not found:
+        raise Http404("No job with that ID exists")
     
-    logger.debug(f"Notified for job '{job}' at {job.last_notified}")
+    return JsonResponse({'success_message': "Job notified successfully."})
+
+
+async def notify_job_async(request, id):
+    # Version of notify_job for ASGI servers, so waiting on the database doesn't tie up a worker per ping.
+    # Database work runs in the ping thread pool (not the single thread sync views share) so pings run concurrently.
+    if getattr(settings, 'PING_RATE_CACHE', None) is None:
+        allowed = pings.allow_ping(id)
+    else:
+        allowed = await pings.run_in_worker(pings.allow_ping, id)
+    if not allowed:
+        return rate_limited()
+    if getattr(settings, 'PING_BUFFER', None) is None:
+        found = await pings.run_in_worker(pings.notify, id) is not None
+    else:
+        # Buffering pings for jobs already seen by this process doesn't need the database at all
+        found = pings.buffer_known_ping(id) or await pings.run_in_worker(pings.buffer_ping, id)
+    if not found:
+        raise Http404("No job with that ID exists")
     
     return JsonResponse({'success_message': "Job notified successfully."})
 
 
+@csrf_exempt
+@require_POST
+def notify_jobs(request):
+    # Notify many jobs at once (e.g. from a host running lots of them). Takes a JSON list of job IDs, or of objects
+    # like {"id": ..., "time": ...} to give the time each one ran as an ISO 8601 timestamp (defaulting to now).
+    # Responds with the result for each ID given: "ok", "not found", "rate limited", "invalid id" or "invalid time".
+    now = timezone.now()
+    try:
+        entries = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error_message': "request body must be valid JSON"}, status=400)
+    if not isinstance(entries, list):
+        return JsonResponse({'error_message': "expected a list of job IDs"}, status=400)
+    if len(entries) > pings.MAX_BULK_PINGS:
+        error_message = f"at most {pings.MAX_BULK_PINGS} jobs can be notified at once"
+        return JsonResponse({'error_message': error_message}, status=400)
+    
+    results = {}
+    keys = defaultdict(list)  # each job ID given to the keys it was given as (which can be spelt differently)
+    times = {}
+    for entry in entries:
+        if isinstance(entry, dict):
+            key, time = str(entry.get('id')), entry.get('time')
+        else:
+            key, time = str(entry), None
+        try:
+            id = uuid.UUID(key)
+        except ValueError:
+            results[key] = "invalid id"
+            continue
+        
+        if time is None:
+            ping_time = now
+        else:
+            try:
+                ping_time = parse_datetime(time)
+            except (TypeError, ValueError):
+                ping_time = None
+            if ping_time is None:
+                results[key] = "invalid time"
+                continue
+            if timezone.is_naive(ping_time):
+                ping_time = timezone.make_aware(ping_time, timezone.utc)
+            # Don't let jobs be notified ahead of time
+            ping_time = min(ping_time, now)
+        
+        if not pings.allow_ping(id):
+            results[key] = "rate limited"
+            continue
+        keys[id].append(key)
+        if id not in times or times[id] < ping_time:
+            times[id] = ping_time
+    
+    notified = pings.notify_many(times) if times else {}
+    for id, id_keys in keys.items():
+        for key in id_keys:
+            results[key] = "ok" if id in notified else "not found"
+    return JsonResponse({'results': results})
+
+
 @login_required
 def dashboard(request, per_page=20):
     if request.is_ajax():
-        for id in request.POST['ids'].split(','):
-            if id.isdigit():
-                event = JobEvent.objects.get(pk=id)
-                event.seen = True
-                event.save()
+        # Mark events as seen with a single update: either those with the given IDs, or all up to a given time
+        events = request.user.all_accessible(JobEvent).filter(seen=False)
+        if 'until' in request.POST:
+            try:
+                until = parse_datetime(request.POST['until'])
+            except ValueError:
+                until = None
+            if until is None:
+                return JsonResponse({'error_message': "invalid time"}, status=400)
+            events = events.filter(time__lte=until)
+        else:
+            events = events.filter(id__in=[int(id) for id in request.POST['ids'].split(',') if id.isdigit()])
+        counters.mark_seen(events)
         
         return JsonResponse({})
     else:
+        # Only the first page is rendered here, and the rest are loaded on demand from dashboard_events
+        if per_page not in DASHBOARD_PAGE_SIZES:
+            raise Http404("Invalid page size")
         timezone.activate(request.user.timezone)
-        events = request.user.all_accessible(JobEvent)
-        pages = [events[i*per_page:(i+1)*per_page] for i in range(math.ceil(events.count() / per_page))]
+        events, next_page = get_events_page(request.user, per_page)
         
         context = {
-            'pages': pages,
+            'events': events,
+            'next_page': next_page,
+            'loaded_at': timezone.now().isoformat(),
             'per_page': per_page,
-            'size_options': (10, 20, 50, 100),
+            'size_options': DASHBOARD_PAGE_SIZES,
         }
         return render(request, 'crontrack/dashboard.html', context)
 
 
+@login_required
+def dashboard_events(request):
+    # Get the next page of the dashboard's event log, as HTML to add to the page along with the next page's cursor
+    timezone.activate(request.user.timezone)
+    try:
+        per_page = int(request.GET.get('per_page', 20))
+        after = (parse_datetime(request.GET['time']), int(request.GET['id']))
+        if per_page not in DASHBOARD_PAGE_SIZES or after[0] is None:
+            raise ValueError
+    except (KeyError, ValueError):
+        return JsonResponse({'error_message': "invalid page"}, status=400)
+    
+    events, next_page = get_events_page(request.user, per_page, after)
+    html = render_to_string('crontrack/dashboardevents.html', {'events': events}, request)
+    return JsonResponse({'html': html, 'next_page': next_page})
+
+
+def get_events_page(user, per_page, after=None):
+    # Get a page of the events a user can see, newest first, using keyset pagination: each page follows on from the
+    # (time, id) of the last event on the previous one, so loading it costs the same however far back it is.
+    # Returns the events and the cursor for the next page (or None if this is the last).
+    events = user.all_accessible(JobEvent).select_related('job').order_by('-time', '-id')
+    if after is not None:
+        time, id = after
+        events = events.filter(Q(time__lt=time) | Q(time=time, id__lt=id))
+    events = list(events[:per_page + 1])
+    if len(events) <= per_page:
+        return events, None
+    last = events[per_page - 1]
+    return events[:per_page], {'time': last.time.isoformat(), 'id': last.id}
+
+
 @login_required
 def view_jobs(request):
     timezone.activate(request.user.timezone)
+    try:
+        filters = get_job_filters(request.GET)
+    except ValueError:
+        raise Http404
+    
+    # Only the first page of groups is rendered here, and the rest are loaded on demand from view_jobs_page
+    now = timezone.now()
+    job_groups, next_page = get_job_page(request.user, filters, now=now)
+    counts = count_jobs(request.user, filters, now)
+    teams = [('All', '(All teams)'), ('None', '(No team)')]
+    teams += [(team.id, team.name) for team in request.user.teams.all()]
+    status_filters = [('all', sum(counts.values()), jobs_query(filters, status=None), filters['status'] is None)]
+    status_filters += [
+        (label.lower(), counts.get(value, 0), jobs_query(filters, status=value), filters['status'] == value)
+        for value, label in Job.STATUS_CHOICES
+    ]
     
     context = {
-        'teams': [{'id': 'All', 'job_groups': [], 'empty': True}],
+        'job_groups': add_group_urls(job_groups, filters),
+        'next_page': next_page,
+        'filters': filters,
         'protocol': settings.SITE_PROTOCOL,
         'domain': settings.SITE_DOMAIN,
-        'tab': request.COOKIES.get('tab', None),
+        'team_tabs': [
+            (name, jobs_query(filters, team=id, group=None), str(id) == str(filters['team'])) for id, name in teams
+        ],
+        'status_filters': status_filters,
+        'sort_url': jobs_query(filters, sort=not filters['sort']),
+        'clear_url': jobs_query(filters, group=None, name='', schedule='', status=None),
+        'page_url': reverse('crontrack:view_jobs_page') + jobs_query(filters),
     }
-    for team in chain((None,), request.user.teams.all()):
-        ungrouped = (get_job_group(request.user, None, team),)
-        grouped = (get_job_group(request.user, g, team) for g in request.user.all_accessible(JobGroup))
-        
-        if team is None:
-            id = None
-        else:
-            id = team.id
-        job_groups = [group for group in chain(ungrouped, grouped) if group is not None]
-        empty = not any(group['jobs'] for group in job_groups)
-        
-        context['teams'].append({'id': id, 'job_groups': job_groups, 'empty': empty})
-        context['teams'][0]['job_groups'] += job_groups
-        context['teams'][0]['empty'] = empty and context['teams'][0]['empty']
-    
     return render(request, 'crontrack/viewjobs.html', context)
 
 
+@login_required
+def view_jobs_page(request):
+    # Get the next page of groups on the view jobs page, as HTML to add to the page along with the next page's cursor
+    timezone.activate(request.user.timezone)
+    try:
+        filters = get_job_filters(request.GET)
+        after = int(request.GET['after'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error_message': "invalid page"}, status=400)
+    
+    job_groups, next_page = get_job_page(request.user, filters, after)
+    context = {
+        'job_groups': add_group_urls(job_groups, filters),
+        'protocol': settings.SITE_PROTOCOL,
+        'domain': settings.SITE_DOMAIN,
+    }
+    html = render_to_string('crontrack/viewjobsgroups.html', context, request)
+    return JsonResponse({'html': html, 'next_page': next_page})
+
+
 @login_required
 def add_job(request):
     context = {'tab': request.COOKIES.get('tab', None)}
@@ -112,7 +277,7 @@ def add_job(request):
                 team = None
             else:
                 team = Team.objects.get(pk=request.POST['team'])
-                if team not in request.user.teams.all():
+                if team.id not in request.user.memberships():
                     team = None
                     logger.warning(f"User {request.user} tried to access a team they're not in: {team}")
             
@@ -149,13 +314,14 @@ def add_job(request):
                             name=job_name,
                             schedule_str=schedule_str,
                             time_window=time_window,
-                            next_run=croniter(schedule_str, now).get_next(datetime),
+                            next_run=next_run(schedule_str, now),
                             group=group,
                             team=team,
                         )
                         job.full_clean()
                         logger.debug(f'Adding new job: {job}')
                         job.save()
+                        reschedule_job(job)
                     else:
                         # We didn't get any jobs
                         raise ValueError("no valid jobs entered")
@@ -175,12 +341,13 @@ def add_job(request):
                     schedule_str=request.POST['schedule_str'],
                     time_window=time_window,
                     description=request.POST['description'],
-                    next_run=croniter(request.POST['schedule_str'], now).get_next(datetime),
+                    next_run=next_run(request.POST['schedule_str'], now),
                     team=team,
                 )
                 job.full_clean()
                 logger.debug(f'Adding new job: {job}')
                 job.save()
+                reschedule_job(job)
 
                 return HttpResponseRedirect(reverse('crontrack:view_jobs'))
         except KeyError:
@@ -215,10 +382,11 @@ def edit_job(request):
                         job.description = request.POST['description']
                         
                         now = timezone.localtime(timezone.now(), request.user.timezone)
-                        job.next_run = croniter(job.schedule_str, now).get_next(datetime)
+                        job.next_run = next_run(job.schedule_str, now)
                         
                         job.full_clean()
                         job.save()
+                    reschedule_job(job)
                 except CroniterBadCronError:
                     context['error_message'] = "invalid cron schedule string"
                 except ValueError:
@@ -304,9 +472,10 @@ def edit_group(request):
                             job.description = request.POST[f'{job_id}__description']
                             
                             now = timezone.localtime(timezone.now())
-                            job.next_run = croniter(job.schedule_str, now).get_next(datetime)
+                            job.next_run = next_run(job.schedule_str, now)
                             job.full_clean()
-                            job.save()                          
+                            job.save()
+                        reschedule_job(job)
             except CroniterBadCronError:
                 context['error_message'] = "invalid cron schedule string"
             except ValueError:
@@ -408,7 +577,7 @@ def teams(request):
         return JsonResponse({})
     else:
         context['membership_alerts'] = {
-            m.team.id for m in TeamMembership.objects.filter(user=request.user) if m.alerts_on
+            team_id for team_id, alerts_on in request.user.memberships().items() if alerts_on
         }
         return render(request, 'crontrack/teams.html', context)
 
@@ -424,6 +593,8 @@ def profile(request):
             request.user.timezone = form.cleaned_data['timezone']
             request.user.alert_method = form.cleaned_data['alert_method']
             request.user.alert_buffer = form.cleaned_data['alert_buffer']
+            request.user.alert_digest = form.cleaned_data['alert_digest']
+            request.user.digest_window = form.cleaned_data['digest_window']
             request.user.email = form.cleaned_data['email']
             request.user.phone = form.cleaned_data['full_phone']
             request.user.save()
@@ -463,6 +634,152 @@ class RegisterView(generic.CreateView):
 
 # --- HELPER FUNCTIONS ---
 
+# Gets the view jobs page's filters from its query string, raising ValueError if any are invalid.
+# team is 'All', 'None' or a team ID, and group is None (any group), 'None' (ungrouped jobs) or a group ID.
+def get_job_filters(params):
+    filters = {
+        'team': params.get('team', 'All'),
+        'group': params.get('group') or None,
+        'name': params.get('name', '').strip(),
+        'schedule': ' '.join(params.get('schedule', '').split()),
+        'status': params.get('status') or None,
+        'sort': params.get('sort') == 'status',
+    }
+    if filters['team'] not in ('All', 'None'):
+        filters['team'] = int(filters['team'])
+    if filters['group'] not in (None, 'None'):
+        filters['group'] = int(filters['group'])
+    if filters['status'] is not None and filters['status'] not in dict(Job.STATUS_CHOICES):
+        raise ValueError(f"invalid status {filters['status']}")
+    return filters
+
+
+# Gets the query string for the view jobs page with the given filters, with any keyword arguments changed
+def jobs_query(filters, **changes):
+    filters = {**filters, **changes}
+    params = {}
+    if filters['team'] != 'All':
+        params['team'] = filters['team']
+    for key in ('group', 'name', 'schedule', 'status'):
+        if filters[key]:
+            params[key] = filters[key]
+    if filters['sort']:
+        params['sort'] = 'status'
+    return '?' + urlencode(params)
+
+
+# Adds a link to each job group showing only that group
+def add_group_urls(job_groups, filters):
+    for group in job_groups:
+        team = 'None' if group['team'] is None else group['team'].id
+        group['url'] = jobs_query(filters, team=team, group=group['id'] or 'None')
+    return job_groups
+
+
+# Gets the conditions for the job groups and the ungrouped jobs shown with the given filters (either of which can be
+# None if there are none). Only groups and jobs in one of the user's teams, or their own without a team, are shown.
+def get_job_scope(user, filters):
+    memberships = user.memberships()
+    if filters['team'] == 'All':
+        team_ids = list(memberships)
+    else:
+        team_ids = [filters['team']] if filters['team'] in memberships else []
+    groups = Q(team__in=team_ids)
+    ungrouped = Q(group__isnull=True, team__in=team_ids)
+    if filters['team'] in ('All', 'None'):
+        groups |= Q(team__isnull=True, user=user)
+        ungrouped |= Q(group__isnull=True, team__isnull=True, user=user)
+    
+    if filters['group'] == 'None':
+        groups = None
+    elif filters['group'] is not None:
+        groups &= Q(id=filters['group'])
+        ungrouped = None
+    return groups, ungrouped
+
+
+# Filters a queryset of jobs by name prefix, schedule and (optionally) status
+def filter_jobs(jobs, filters, now, status=True):
+    if filters['name']:
+        jobs = jobs.filter(name__startswith=filters['name'])
+    if filters['schedule']:
+        jobs = jobs.filter(schedule_str=filters['schedule'])
+    if status and filters['status'] is not None:
+        jobs = jobs.filter_status(filters['status'], now)
+    return jobs
+
+
+# Gets a page of the job groups shown with the given filters, each with its jobs (a list in the format given by
+# get_job_group). Pages are keyed on group ID: the first has the ungrouped jobs of each team shown followed by the
+# first groups by ID, and each later one follows on from the last group on the page before, so loading it costs the
+# same however far down it is. Groups are skipped if they have no jobs matching a filter.
+# Returns the job groups and the cursor for the next page (or None if this is the last).
+def get_job_page(user, filters, after=None, per_page=JOB_GROUPS_PER_PAGE, now=None):
+    # Every job's status is worked out as at the same time
+    if now is None:
+        now = timezone.now()
+    group_scope, ungrouped_scope = get_job_scope(user, filters)
+    jobs = filter_jobs(Job.objects.all(), filters, now)
+    
+    groups = []
+    if group_scope is not None:
+        groups = JobGroup.objects.filter(group_scope).select_related('team').order_by('id')
+        if after is not None:
+            groups = groups.filter(id__gt=after)
+        if filters['name'] or filters['schedule'] or filters['status']:
+            groups = groups.filter(Exists(jobs.filter(group=OuterRef('pk'))))
+        groups = list(groups[:per_page + 1])
+    next_page = groups[per_page - 1].id if len(groups) > per_page else None
+    groups = groups[:per_page]
+    
+    page = Q(group__in=[group.id for group in groups])
+    if after is None and ungrouped_scope is not None:
+        page |= ungrouped_scope
+    jobs = jobs.filter(page).select_related('team').with_status(now)
+    if filters['sort']:
+        # Alphabetical order is also most to least severe
+        jobs = jobs.order_by('status')
+    
+    # Ungrouped jobs are keyed by (None, team ID) and the rest by their group's ID
+    group_jobs = defaultdict(list)
+    ungrouped_teams = {}
+    for job in jobs:
+        if job.group_id is None:
+            group_jobs[(None, job.team_id)].append(job)
+            ungrouped_teams[job.team_id] = job.team
+        else:
+            group_jobs[job.group_id].append(job)
+    
+    # Jobs without a team come first, then each team's (skipping showing the 'Ungrouped' group if it's empty)
+    job_groups = [
+        {'id': None, 'name': 'Ungrouped', 'description': '', 'jobs': group_jobs[(None, team_id)], 'team': team}
+        for team_id, team in sorted(ungrouped_teams.items(), key=lambda item: (item[0] is not None, item[0] or 0))
+    ]
+    for group in groups:
+        job_groups.append({
+            'id': group.id, 'name': group.name, 'description': group.description, 'jobs': group_jobs[group.id],
+            'team': group.team,
+        })
+    return job_groups, next_page
+
+
+# Gets all the jobs in the teams and groups shown with the given filters (on every page) as a single queryset
+def get_scoped_jobs(user, filters):
+    group_scope, ungrouped_scope = get_job_scope(user, filters)
+    scope = Q(id__in=[])
+    if group_scope is not None:
+        scope |= Q(group__in=JobGroup.objects.filter(group_scope).values('id'))
+    if ungrouped_scope is not None:
+        scope |= ungrouped_scope
+    return Job.objects.filter(scope)
+
+
+# Counts the jobs shown with the given filters (on every page) by status, with a single query
+def count_jobs(user, filters, now):
+    jobs = filter_jobs(get_scoped_jobs(user, filters), filters, now, status=False)
+    return dict(jobs.with_status(now).order_by().values_list('status').annotate(count=Count('id')))
+
+
 # Gets a user's job group information with their corresponding jobs
 def get_job_group(user, job_group, team):
     # Try to convert the team to an object
@@ -0,0 +1,19 @@
+"""
+ASGI config for crontrack_site project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Job pings are handled by an async view when served this way (see settings.ASYNC_PINGS), so a single process can
+hold many in-flight pings at once, e.g. with: uvicorn crontrack_site.asgi:application
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crontrack_site.settings')
+os.environ.setdefault('CRONTRACK_ASYNC_PINGS', '1')
+
+application = get_asgi_application()
@@ -7,6 +7,26 @@ from django.urls import reverse_lazy
 
 DEBUG = False
 JOB_MONITOR_ON = True  # Whether to run the job alert monitor
+JOB_MONITOR_EVENT_DRIVEN = False  # Whether the monitor sleeps until the next job is due rather than polling
+ALERT_WORKERS = 4  # Number of threads used to send alerts
+ALERT_RETENTION_DAYS = 30  # Days to keep sent and given up alerts for before deleting them (None to keep them)
+JOB_RUN_HORIZON = 60  # Number of upcoming run times to store per job (0 to calculate each one when needed)
+PING_BUFFER = None  # Buffer pings to write in batches, in memory ('memory') or also in a file ('spool'), or not (None)
+PING_BUFFER_DELAY = 500  # Maximum time in milliseconds a buffered ping waits to be written
+PING_BUFFER_FSYNC = False  # Whether to fsync the spool file after each ping (so pings survive power loss too)
+PING_RATE_LIMIT = None  # Maximum average pings per minute per job, beyond which they're rejected (None for no limit)
+PING_RATE_BURST = 20  # Number of pings a job can send at once within the rate limit
+PING_RATE_CACHE = None  # Cache alias to share rate limits between processes with (None to limit each separately)
+ASYNC_PINGS = os.environ.get('CRONTRACK_ASYNC_PINGS') == '1'  # Whether to use the async ping view (set by asgi.py)
+ASYNC_PING_THREADS = 32  # Number of threads (and so database connections) per process for the async ping view
+UNSEEN_COUNT_CACHE = 'default'  # Cache alias for unseen event counts (counted on each page view unless it's shared)
+UNSEEN_COUNT_TIMEOUT = 60  # Seconds a cached unseen event count is kept for before being counted again
+CHANGE_COUNTER_CACHE = 'default'  # Cache alias for the API's change counters (no ETags unless it's shared)
+CHANGE_COUNTER_TIMEOUT = 60  # Seconds a change counter is kept for before starting again (invalidating API ETags)
+MEMBERSHIP_CACHE = 'default'  # Cache alias to share users' team memberships between requests with
+MEMBERSHIP_CACHE_TIMEOUT = 0  # Seconds to keep team memberships in the cache for (0 to only cache them per request)
+EVENT_RETENTION_DAYS = 90  # Days to keep events for before archiving them as daily summaries (None to keep them)
+EVENT_ARCHIVE_INTERVAL = None  # Hours between archiving old events in the job monitor (None to only use the command)
 
 SITE_PROTOCOL = 'https'
 SITE_DOMAIN = 'crontrack.com'
@@ -15,6 +35,7 @@ CSRF_COOKIE_SECURE = True
 SESSION_COOKIE_SECURE = True
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PING_SPOOL_DIR = os.path.join(BASE_DIR, 'pingspool')  # Where spool files are kept if PING_BUFFER is 'spool'
 
 AUTH_USER_MODEL = 'crontrack.User'
 
@@ -51,6 +72,10 @@ LOGGING = {
             'handlers': ['console'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG'),
         },
+        'crontrack.alerts': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG'),
+        },
     },
     'formatters': {
         'simple': {
@@ -106,6 +131,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'crontrack_site.wsgi.application'
+ASGI_APPLICATION = 'crontrack_site.asgi.application'
 
 
 # Password validation